@@ -0,0 +1,57 @@
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers import asgi
+from django.http import StreamingHttpResponse
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """Потоковый ответ, части которого читаются из базы по мере отдачи.
+    Под WSGI и в тестах это обычный StreamingHttpResponse. Django 3.2 читает
+    потоковые ответы синхронно прямо в цикле событий, поэтому под ASGI такой
+    ответ отдает ASGIHandler ниже, читая каждую часть через sync_to_async."""
+
+    async def async_chunks(self):
+        chunks = iter(self.streaming_content)
+        read = sync_to_async(next, thread_sensitive=True)
+        while True:
+            chunk = await read(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    async def send_response(self, response, send):
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            await super().send_response(response, send)
+            return
+        headers = [
+            (header.encode("ascii"), value.encode("latin1"))
+            for header, value in response.items()
+        ]
+        headers.extend(
+            (b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            for cookie in response.cookies.values()
+        )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": headers,
+            }
+        )
+        async for chunk in response.async_chunks():
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": True,
+                }
+            )
+        await send({"type": "http.response.body"})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application():
+    django.setup(set_prefix=False)
+    return ASGIHandler()
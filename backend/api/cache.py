@@ -0,0 +1,63 @@
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+VERSION_KEY = "nodes:version:{}"
+SUBTREE_KEY = "nodes:{}:{}"
+
+
+def nodes_cache():
+    return caches[settings.NODES_CACHE]
+
+
+def is_shared_cache() -> bool:
+    """Видят ли кэш другие процессы. LocMemCache у каждого процесса свой,
+    сброс из воркера до веб-процессов в нем не дойдет."""
+    return not isinstance(nodes_cache(), LocMemCache)
+
+
+def subtree_key(node_id: str) -> str:
+    """Ключ ответа GET /nodes/{id}: id узла и текущая версия. Версия
+    меняется при инвалидации, старые ответы просто перестают читаться."""
+    cache = nodes_cache()
+    version_key = VERSION_KEY.format(node_id)
+    version = uuid4().hex
+    if not cache.add(version_key, version, timeout=None):
+        version = cache.get(version_key, version)
+    return SUBTREE_KEY.format(node_id, version)
+
+
+def cached_subtree(node_id: str) -> tuple:
+    """Ключ ответа GET /nodes/{id} и тело из кэша или None."""
+    key = subtree_key(node_id)
+    return key, nodes_cache().get(key)
+
+
+def cache_stream(chunks, key: str):
+    """Отдает части ответа дальше и сохраняет их в кэш, если ответ дочитан
+    до конца и не больше NODES_CACHE_MAX_SIZE."""
+    body, size = [], 0
+    for chunk in chunks:
+        yield chunk
+        if body is None:
+            continue
+        size += len(chunk)
+        if size > settings.NODES_CACHE_MAX_SIZE:
+            body = None
+        else:
+            body.append(chunk)
+    if body is not None:
+        nodes_cache().set(key, b"".join(body))
+
+
+def invalidate_nodes(node_ids):
+    """Сбрасывает версии узлов сразу и повторно после коммита, чтобы ответ,
+    собранный параллельным чтением до коммита, не остался в кэше."""
+    keys = [VERSION_KEY.format(node_id) for node_id in node_ids]
+    if not keys:
+        return
+    nodes_cache().delete_many(keys)
+    transaction.on_commit(lambda: nodes_cache().delete_many(keys))
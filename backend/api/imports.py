@@ -0,0 +1,248 @@
+from collections import defaultdict
+
+from django.db import IntegrityError
+from django.db.models import Max
+from mptt.exceptions import InvalidMove
+from rest_framework.exceptions import NotFound, ValidationError
+
+from api.cache import invalidate_nodes
+from core.models import (
+    TYPE_NAME,
+    FileSystem,
+    SizePropagation,
+    bulk_position_history,
+    tree_backend,
+)
+from core.tree import NEW_TREE, TreesChangedError, check_locked, run_locked
+
+IMPORT_BATCH_SIZE = 1000
+
+
+class NodesImport:
+    """Импорт пачки элементов. Число запросов к базе не зависит от размера
+    пачки: узлы загружаются одним запросом, пачка разбирается как граф в
+    памяти, новые узлы вставляются bulk_create в топологическом порядке,
+    размер, счетчики и дата папок-предков меняются один раз на папку, при
+    переносе - только ниже общего предка старого и нового места. Импорт
+    идет под блокировками затронутых деревьев, см. run_locked."""
+
+    def __init__(self, items: list, update_date):
+        self.items = items
+        self.update_date = update_date
+        self.tree_ids = set()
+        self.nodes = {}
+        self.parents = {}
+        self.existing = []
+        self.created = []
+        self.updated = []
+        self.moved = []
+        self.shared = set()
+        self.propagation = SizePropagation(date=update_date)
+        self.tree = tree_backend()
+
+    def run(self):
+        run_locked(self._tree_ids(), self._run)
+
+    def _run(self, tree_ids: set):
+        self.tree_ids = tree_ids
+        self.created, self.updated, self.moved = [], [], []
+        self.shared = set()
+        self.propagation = SizePropagation(date=self.update_date)
+        self._load()
+        check_locked(tree_ids, self.existing)
+        for item in self._sorted_items():
+            self._apply(item)
+        self._create()
+        self._move()
+        self._update()
+        invalidate_nodes(
+            {item["id"] for item in self.items}.union(
+                self.propagation.deltas, self.shared
+            )
+        )
+        history = self._history()
+        self.propagation.save()
+        bulk_position_history(history)
+
+    def _ids(self) -> set:
+        ids = {item["id"] for item in self.items}
+        ids.update(
+            item["parentId"]
+            for item in self.items
+            if item["parentId"] is not None
+        )
+        return ids
+
+    def _tree_ids(self) -> set:
+        """Деревья, которые затронет импорт, по состоянию до блокировки.
+        NEW_TREE - если пачка создает новые корни."""
+        found = dict(
+            FileSystem.objects.filter(id__in=self._ids()).values_list(
+                "id", "tree_id"
+            )
+        )
+        tree_ids = set(found.values())
+        if any(
+            item["parentId"] is None and item["id"] not in found
+            for item in self.items
+        ):
+            tree_ids.add(NEW_TREE)
+        return tree_ids
+
+    def _load(self):
+        ids = self._ids()
+        self.existing = list(FileSystem.objects.filter(id__in=ids))
+        self.existing.extend(
+            node
+            for node in self.tree.ancestors(self.existing)
+            if node.id not in ids
+        )
+        self.nodes = {node.id: node for node in self.existing}
+        self.parents = {node.id: node.parent_id for node in self.existing}
+
+    def _sorted_items(self) -> list:
+        """Элементы пачки в топологическом порядке: родитель из той же пачки
+        всегда обрабатывается раньше своих детей."""
+        batch_ids = {item["id"] for item in self.items}
+        children = defaultdict(list)
+        ordered = []
+        for item in self.items:
+            if item["parentId"] in batch_ids:
+                children[item["parentId"]].append(item)
+            else:
+                ordered.append(item)
+        for item in ordered:
+            ordered.extend(children.pop(item["id"], ()))
+        if len(ordered) != len(self.items):
+            raise ValidationError({"detail": "Циклическая зависимость"})
+        return ordered
+
+    def _apply(self, item: dict):
+        node_id, parent_id = item["id"], item["parentId"]
+        if parent_id is not None:
+            self._check_parent(node_id, parent_id)
+        node = self.nodes.get(node_id)
+        if node is None:
+            node = FileSystem(
+                id=node_id,
+                url=item.get("url"),
+                type=TYPE_NAME[item["type"]],
+                parent_id=parent_id,
+                date=self.update_date,
+                size=item.get("size") or 0,
+            )
+            self.nodes[node_id] = node
+            self.parents[node_id] = parent_id
+            self.created.append(node)
+            self.propagation.add(
+                self._chain(parent_id), node.size, *node.subtree_counts()
+            )
+            return
+
+        old_size = self._size(node_id)
+        if item.get("size"):
+            node.size = item["size"]
+        if item.get("url"):
+            node.url = item["url"]
+        node.date = self.update_date
+        self.updated.append(node)
+        old_parent_id = self.parents[node_id]
+        if parent_id and parent_id != old_parent_id:
+            old_chain = list(self._chain(old_parent_id))
+            self.parents[node_id] = parent_id
+            self.moved.append((node, parent_id))
+            self.shared.update(
+                self.propagation.add_move(
+                    old_chain,
+                    list(self._chain(parent_id)),
+                    old_size,
+                    self._size(node_id),
+                    *self._counts(node_id),
+                )
+            )
+        else:
+            self.propagation.add(
+                self._chain(old_parent_id), self._size(node_id) - old_size
+            )
+
+    def _check_parent(self, node_id: str, parent_id: str):
+        parent = self.nodes.get(parent_id)
+        if parent is None:
+            raise NotFound()
+        if parent.is_file():
+            raise ValidationError({"detail": "Родитель только папка"})
+        if node_id in self._chain(parent_id):
+            raise ValidationError({"detail": "Циклическая зависимость"})
+
+    def _size(self, node_id: str) -> int:
+        return self.nodes[node_id].size + self.propagation.get(node_id)
+
+    def _counts(self, node_id: str) -> tuple:
+        files, folders = self.nodes[node_id].subtree_counts()
+        added_files, added_folders = self.propagation.get_counts(node_id)
+        return files + added_files, folders + added_folders
+
+    def _chain(self, node_id):
+        """Папка node_id и все её предки в текущем состоянии импорта."""
+        while node_id is not None:
+            yield node_id
+            node_id = self.parents[node_id]
+
+    def _create(self):
+        if not self.created:
+            return
+        roots = []
+        for node in self.created:
+            node.size += self.propagation.pop(node.id)
+            files, folders = self.propagation.pop_counts(node.id)
+            node.file_count += files
+            node.folder_count += folders
+            node.snapshot = node.render_snapshot()
+            if node.parent_id is None:
+                roots.append(node)
+        if roots:
+            if NEW_TREE not in self.tree_ids:
+                raise TreesChangedError(self.tree_ids | {NEW_TREE})
+            tree_id = FileSystem.objects.aggregate(Max("tree_id"))
+            tree_id = tree_id["tree_id__max"] or 0
+            for node in roots:
+                tree_id += 1
+                node.tree_id = tree_id
+        try:
+            self.tree.insert(self.created, self.nodes, self.existing)
+        except IntegrityError:
+            raise ValidationError({"detail": "Ошибка создания"})
+
+    def _move(self):
+        moves = [
+            (node, self.nodes[parent_id]) for node, parent_id in self.moved
+        ]
+        try:
+            self.tree.move(moves)
+        except InvalidMove:
+            raise ValidationError({"detail": "Циклическая зависимость"})
+
+    def _history(self) -> list:
+        """Состояния узлов пачки и всех затронутых папок-предков после
+        импорта, для записи в историю одним bulk_create."""
+        nodes = {node.id: node for node in self.created + self.updated}
+        for node_id, delta in self.propagation.deltas.items():
+            node = self.nodes[node_id]
+            node.size += delta
+            node.date = self.update_date
+            nodes[node_id] = node
+        return list(nodes.values())
+
+    def _update(self):
+        for node in self.updated:
+            node.snapshot = node.render_snapshot()
+        files = [node for node in self.updated if node.is_file()]
+        folders = [node for node in self.updated if node.is_folder()]
+        FileSystem.objects.bulk_update(
+            files,
+            ("url", "size", "date", "snapshot"),
+            batch_size=IMPORT_BATCH_SIZE,
+        )
+        FileSystem.objects.bulk_update(
+            folders, ("date", "snapshot"), batch_size=IMPORT_BATCH_SIZE
+        )
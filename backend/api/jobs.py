@@ -0,0 +1,116 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+
+from api.exception import ERROR_MESSAGES
+from api.imports import NodesImport
+from core.models import (
+    JOB_DONE,
+    JOB_FAILED,
+    JOB_PENDING,
+    JOB_RUNNING,
+    FileSystem,
+    ImportJob,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_import(items: list, update_date) -> ImportJob:
+    """Ставит проверенную пачку в очередь. Ключи узлов, которые создадут
+    еще не выполненные задания, наследуют ключи этих заданий: импорт в
+    только что поставленную папку встанет в очередь за её созданием."""
+    unfinished = ImportJob.objects.filter(
+        status__in=(JOB_PENDING, JOB_RUNNING)
+    ).values_list("keys", flat=True)
+    pending_keys = [set(keys) for keys in unfinished]
+
+    ids = {item["id"] for item in items}
+    ids.update(
+        item["parentId"] for item in items if item["parentId"] is not None
+    )
+    found = dict(
+        FileSystem.objects.filter(id__in=ids).values_list("id", "tree_id")
+    )
+    keys = {f"tree:{tree_id}" for tree_id in found.values()}
+    for node_id in ids.difference(found):
+        key = f"node:{node_id}"
+        keys.add(key)
+        for job_keys in pending_keys:
+            if key in job_keys:
+                keys.update(job_keys)
+    return ImportJob.objects.create(
+        items=items, update_date=update_date, keys=sorted(keys)
+    )
+
+
+def claim_job():
+    """Забирает самое старое задание, ключи которого не пересекаются с
+    ключами более ранних невыполненных заданий. None, если таких нет."""
+    with transaction.atomic():
+        jobs = (
+            ImportJob.objects.select_for_update()
+            .filter(status__in=(JOB_PENDING, JOB_RUNNING))
+            .order_by("id")
+            .values_list("id", "status", "keys")
+        )
+        busy = set()
+        for job_id, job_status, keys in jobs:
+            if job_status == JOB_PENDING and busy.isdisjoint(keys):
+                claimed = ImportJob.objects.filter(
+                    id=job_id, status=JOB_PENDING
+                ).update(status=JOB_RUNNING, started=timezone.now())
+                if claimed:
+                    return ImportJob.objects.get(id=job_id)
+            busy.update(keys)
+    return None
+
+
+def run_job(job: ImportJob):
+    try:
+        NodesImport(items=job.items, update_date=job.update_date).run()
+    except APIException as error:
+        job.status = JOB_FAILED
+        job.error = _error(error.status_code, error.detail)
+    except Exception as error:
+        logger.exception("Import job %s failed", job.id)
+        job.status = JOB_FAILED
+        job.error = _error(500, repr(error))
+    else:
+        job.status = JOB_DONE
+    job.finished = timezone.now()
+    job.save(update_fields=("status", "error", "finished"))
+
+
+def _error(status_code: int, detail) -> dict:
+    if isinstance(detail, dict):
+        detail = detail.get("detail", detail)
+    return dict(
+        code=status_code,
+        message=ERROR_MESSAGES.get(status_code, str(detail)),
+        detail=str(detail),
+    )
+
+
+def requeue_jobs() -> int:
+    """Возвращает в очередь задания, брошенные упавшими воркерами."""
+    return ImportJob.objects.filter(status=JOB_RUNNING).update(
+        status=JOB_PENDING, started=None
+    )
+
+
+def work(once: bool = False):
+    """Цикл воркера. С once выходит, когда в очереди не осталось заданий,
+    которые можно начать."""
+    while True:
+        job = claim_job()
+        if job is not None:
+            run_job(job)
+            continue
+        if once and not ImportJob.objects.filter(status=JOB_PENDING).exists():
+            return
+        time.sleep(settings.IMPORT_WORKER_POLL)
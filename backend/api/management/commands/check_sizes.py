@@ -0,0 +1,102 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.cache import invalidate_nodes
+from core.models import (
+    TOTALS_BATCH_SIZE,
+    TOTALS_FIELDS,
+    FileSystem,
+    folder_totals,
+    format_date,
+    refresh_snapshots,
+)
+from core.tree import lock_trees
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересчитывает размер, счетчики файлов и папок и дату папок по их "
+        "поддеревьям и печатает расхождения. С --fix исправляет их пачками, "
+        "каждое дерево под своей блокировкой"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Исправить расхождения",
+        )
+        parser.add_argument(
+            "--tree",
+            type=int,
+            action="append",
+            dest="tree_ids",
+            help="Проверить только дерево с этим tree_id, можно несколько",
+        )
+
+    def handle(self, *args, **options):
+        tree_ids = options["tree_ids"] or list(
+            FileSystem.objects.filter(parent=None)
+            .order_by("tree_id")
+            .values_list("tree_id", flat=True)
+        )
+        found = 0
+        for tree_id in tree_ids:
+            if not options["fix"]:
+                found += self.check_tree(tree_id, False)
+                continue
+            with transaction.atomic():
+                lock_trees({tree_id})
+                found += self.check_tree(tree_id, True)
+        action = "исправлено" if options["fix"] else "найдено"
+        self.stdout.write(
+            f"Деревьев: {len(tree_ids)}, расхождений {action}: {found}"
+        )
+
+    def check_tree(self, tree_id: int, fix: bool) -> int:
+        """Печатает расхождения дерева tree_id и с fix записывает верные
+        значения по TOTALS_BATCH_SIZE папок. Возвращает число папок с
+        расхождениями."""
+        found, stale, repaired = 0, [], []
+        for node_id, stored, expected in folder_totals(tree_id):
+            if stored != expected:
+                found += 1
+                self.report(tree_id, node_id, stored, expected)
+            if not fix:
+                continue
+            stale.append(node_id)
+            if stored != expected:
+                repaired.append(
+                    FileSystem(
+                        id=node_id,
+                        snapshot=None,
+                        **dict(zip(TOTALS_FIELDS, expected)),
+                    )
+                )
+            if len(stale) >= TOTALS_BATCH_SIZE:
+                self.save(repaired, stale)
+                stale, repaired = [], []
+        if fix:
+            self.save(repaired, stale)
+        return found
+
+    def report(self, tree_id: int, node_id: str, stored, expected):
+        changes = ", ".join(
+            f"{field} {_display(old)} -> {_display(new)}"
+            for field, old, new in zip(TOTALS_FIELDS, stored, expected)
+            if old != new
+        )
+        self.stdout.write(f"Дерево {tree_id}, {node_id}: {changes}")
+
+    def save(self, repaired: list, stale: list):
+        FileSystem.objects.bulk_update(
+            repaired, TOTALS_FIELDS + ("snapshot",)
+        )
+        if settings.NODES_SNAPSHOTS:
+            refresh_snapshots([node.id for node in repaired])
+        invalidate_nodes(stale)
+
+
+def _display(value) -> str:
+    return str(value) if isinstance(value, int) else format_date(value)
@@ -0,0 +1,58 @@
+from multiprocessing import Process
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from api.cache import is_shared_cache
+from api.jobs import requeue_jobs, work
+
+
+class Command(BaseCommand):
+    help = "Выполняет отложенные импорты из очереди ImportJob"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=settings.IMPORT_WORKERS,
+            help="Число процессов-воркеров",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Выйти, когда очередь опустеет",
+        )
+        parser.add_argument(
+            "--requeue",
+            action="store_true",
+            help="Вернуть в очередь задания, брошенные упавшими воркерами",
+        )
+
+    def handle(self, *args, **options):
+        if not is_shared_cache():
+            raise CommandError(
+                "Кэш ответов в памяти процесса: импорты воркера не сбросят "
+                "его в веб-процессах. Нужен общий CACHE_BACKEND (db, file)"
+            )
+        if options["requeue"]:
+            count = requeue_jobs()
+            self.stdout.write(f"Возвращено в очередь: {count}")
+        processes = options["processes"]
+        if connection.vendor == "sqlite" and processes > 1:
+            # SQLite не ждет блокировку записи, а сразу падает.
+            self.stdout.write("SQLite: воркер запускается в одном процессе")
+            processes = 1
+        if processes <= 1:
+            work(options["once"])
+            return
+        # Соединения с базой не должны переходить в дочерние процессы.
+        connections.close_all()
+        processes = [
+            Process(target=work, args=(options["once"],))
+            for _ in range(processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import FileSystem, tree_backend
+from core.tree import NEW_TREE, lock_trees
+
+
+class Command(BaseCommand):
+    help = (
+        "Перестраивает структуру дерева движка TREE_BACKEND по parent_id. "
+        "Нужна после смены TREE_BACKEND на базе с данными"
+    )
+
+    def handle(self, *args, **options):
+        tree_ids = FileSystem.objects.values_list("tree_id", flat=True)
+        with transaction.atomic():
+            lock_trees(set(tree_ids.distinct()) | {NEW_TREE})
+            count = tree_backend().rebuild()
+        self.stdout.write(f"{settings.TREE_BACKEND}: перезаписано {count}")
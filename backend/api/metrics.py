@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+SLOW_QUERIES_SHOWN = 10
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_current = ContextVar("request_metrics", default=None)
+
+
+class Histogram:
+    """Гистограмма Prometheus в памяти процесса. Метки - (endpoint,
+    method)."""
+
+    def __init__(self, name: str, documentation: str, buckets: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        with self.lock:
+            counts = self.values.setdefault(
+                labels, [0] * (len(self.buckets) + 1) + [0]
+            )
+            for number, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[number] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def get(self, labels: tuple) -> tuple:
+        """(число наблюдений, сумма) с метками labels."""
+        with self.lock:
+            counts = self.values.get(labels)
+        return (counts[-2], counts[-1]) if counts else (0, 0)
+
+    def render(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            values = sorted(
+                (labels, list(counts))
+                for labels, counts in self.values.items()
+            )
+        for (endpoint, method), counts in values:
+            labels = f'endpoint="{_escape(endpoint)}",method="{method}"'
+            bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                lines.append(
+                    f'{self.name}_bucket{{{labels},le="{bound}"}} {count}'
+                )
+            lines.append(f"{self.name}_sum{{{labels}}} {counts[-1]}")
+            lines.append(f"{self.name}_count{{{labels}}} {counts[-2]}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    )
+
+
+REQUEST_DURATION = Histogram(
+    "enrollment_request_duration_seconds",
+    "Request duration including streamed body.",
+    SECONDS_BUCKETS,
+)
+DB_QUERIES = Histogram(
+    "enrollment_db_queries", "SQL queries per request.", QUERIES_BUCKETS
+)
+DB_DURATION = Histogram(
+    "enrollment_db_duration_seconds",
+    "Time spent in SQL queries per request.",
+    SECONDS_BUCKETS,
+)
+SERIALIZATION_DURATION = Histogram(
+    "enrollment_serialization_duration_seconds",
+    "Time spent rendering or streaming the response body.",
+    SECONDS_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+    "enrollment_response_size_bytes", "Response body size.", BYTES_BUCKETS
+)
+HISTOGRAMS = (
+    REQUEST_DURATION,
+    DB_QUERIES,
+    DB_DURATION,
+    SERIALIZATION_DURATION,
+    RESPONSE_SIZE,
+)
+
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    """Замеры одного запроса. Запросы к базе считает record_query, пока
+    замер текущий в контексте, в том числе в sync_to_async и при отдаче
+    потокового ответа."""
+
+    def __init__(self, request):
+        self.request = request
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0
+        self.serialization = 0
+        self.size = 0
+        self.statements = defaultdict(lambda: [0, 0])
+        self.finished = False
+
+    def add_query(self, sql: str, duration: float):
+        self.queries += 1
+        self.db_time += duration
+        if settings.METRICS_SLOW_REQUEST_MS:
+            statement = self.statements[sql]
+            statement[0] += 1
+            statement[1] += duration
+
+    def track(self, response):
+        """Заканчивает замер, а у потокового ответа - после отдачи тела."""
+        self.response = response
+        if response.streaming:
+            response.streaming_content = self._chunks(
+                response.streaming_content
+            )
+        else:
+            self.size = len(response.content)
+            self.finish()
+        return response
+
+    def _chunks(self, chunks):
+        iterator = iter(chunks)
+        try:
+            while True:
+                token = _current.set(self)
+                start = time.perf_counter()
+                try:
+                    chunk = next(iterator, None)
+                finally:
+                    self.serialization += time.perf_counter() - start
+                    _current.reset(token)
+                if chunk is None:
+                    return
+                self.size += len(chunk)
+                yield chunk
+        finally:
+            self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.perf_counter() - self.start
+        match = self.request.resolver_match
+        labels = (
+            match.url_name if match else "unmatched",
+            self.request.method,
+        )
+        REQUEST_DURATION.observe(labels, duration)
+        DB_QUERIES.observe(labels, self.queries)
+        DB_DURATION.observe(labels, self.db_time)
+        SERIALIZATION_DURATION.observe(labels, self.serialization)
+        RESPONSE_SIZE.observe(labels, self.size)
+        threshold = settings.METRICS_SLOW_REQUEST_MS
+        if threshold and duration * 1000 >= threshold:
+            self._log_slow(duration)
+
+    def _log_slow(self, duration: float):
+        statements = sorted(
+            self.statements.items(), key=lambda item: -item[1][1]
+        )
+        breakdown = "".join(
+            f"\n  {count} x {total * 1000:.1f} ms: {sql[:200]}"
+            for sql, (count, total) in statements[:SLOW_QUERIES_SHOWN]
+        )
+        logger.warning(
+            "Slow request %s %s: %.1f ms, status %s, %s queries, "
+            "db %.1f ms, serialization %.1f ms, %s bytes%s",
+            self.request.method,
+            self.request.get_full_path(),
+            duration * 1000,
+            self.response.status_code,
+            self.queries,
+            self.db_time * 1000,
+            self.serialization * 1000,
+            self.size,
+            breakdown,
+        )
+
+
+def record_query(execute, sql, params, many, context):
+    """Обертка выполнения SQL: время запроса идет в текущий замер."""
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(sql, time.perf_counter() - start)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """Обработчик connection_created: record_query на каждое соединение.
+    В отличие от connection.queries работает и без DEBUG."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class MetricsMiddleware:
+    """Замеряет каждый запрос: число и время SQL-запросов, время
+    сериализации, размер ответа и общую длительность по эндпоинтам
+    (имени url). Работает и в синхронной, и в асинхронной цепочке, чтобы
+    асинхронные обработчики под ASGI не уходили в поток."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Как в MiddlewareMixin: так Django видит асинхронный режим.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self._async_call(request)
+        metrics = RequestMetrics(request)
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return metrics.track(response)
+
+    async def _async_call(self, request):
+        metrics = RequestMetrics(request)
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return metrics.track(response)
+
+    def process_template_response(self, request, response):
+        """Ответы DRF рендерятся после всех middleware: время от этого
+        вызова до post-render callback - сериализация."""
+        metrics = _current.get()
+        if metrics is None:
+            return response
+        start = time.perf_counter()
+
+        def rendered(response):
+            metrics.serialization += time.perf_counter() - start
+
+        response.add_post_render_callback(rendered)
+        return response
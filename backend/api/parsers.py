@@ -0,0 +1,128 @@
+import codecs
+import json
+import re
+
+from rest_framework import serializers
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.utils.json import strict_constant
+
+from api.validators import validate_import_item
+
+IMPORT_READ_SIZE = 64 * 1024
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class JSONStream:
+    """Читает JSON из потока по частям. В памяти только непрочитанный
+    хвост текущей части, значения разбираются json.JSONDecoder по одному."""
+
+    def __init__(self, stream, encoding: str):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.json = json.JSONDecoder(parse_constant=strict_constant)
+        self.buffer = ""
+        self.pos = 0
+        self.eof = stream is None
+
+    def read(self) -> bool:
+        """Дочитывает следующую часть тела. False, если тело кончилось."""
+        if self.eof:
+            return False
+        chunk = self.stream.read(IMPORT_READ_SIZE)
+        self.eof = not chunk
+        try:
+            text = self.decoder.decode(chunk, final=self.eof)
+        except UnicodeDecodeError as error:
+            raise ParseError(f"JSON parse error - {error}")
+        consumed, self.pos = self.pos, 0
+        self.buffer = self.buffer[consumed:] + text
+        return not self.eof or bool(text)
+
+    def peek(self) -> str:
+        """Следующий значащий символ без сдвига, пустая строка в конце."""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read():
+                return ""
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise ParseError(f"JSON parse error - expected {chars!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as error:
+                # Значение могло оборваться на границе части.
+                if self.read():
+                    continue
+                raise ParseError(f"JSON parse error - {error}")
+            except ValueError as error:
+                raise ParseError(f"JSON parse error - {error}")
+            # Число на границе части могло быть прочитано не полностью.
+            if end == len(self.buffer) and self.read():
+                continue
+            self.pos = end
+            return value
+
+
+def parse_import(stream, encoding: str) -> tuple:
+    """Разбирает и проверяет тело POST /imports, не загружая его целиком:
+    элементы items проверяются validate_import_item по одному по мере
+    чтения. Правила те же, что у NodesImportsSerializer. Возвращает
+    (items, updateDate)."""
+    reader = JSONStream(stream, encoding)
+    items, update_date = None, serializers.empty
+    reader.expect("{")
+    if reader.peek() == "}":
+        reader.expect("}")
+    else:
+        while True:
+            key = reader.value()
+            if not isinstance(key, str):
+                raise ParseError("JSON parse error - expected key")
+            reader.expect(":")
+            if key == "items" and reader.peek() == "[":
+                items = _items(reader)
+            elif key == "items":
+                items = reader.value()
+            elif key == "updateDate":
+                update_date = reader.value()
+            else:
+                reader.value()
+            if reader.expect(",}") == "}":
+                break
+    if reader.peek():
+        raise ParseError("JSON parse error - extra data")
+
+    if not isinstance(items, list):
+        raise ValidationError({"items": "Ожидался список"})
+    if not items:
+        raise ValidationError({"items": "Пустое значение"})
+    try:
+        update_date = serializers.DateTimeField().run_validation(update_date)
+    except ValidationError as error:
+        raise ValidationError({"updateDate": error.detail})
+    return items, update_date
+
+
+def _items(reader: JSONStream) -> list:
+    items = []
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.expect("]")
+        return items
+    while True:
+        try:
+            items.append(validate_import_item(reader.value()))
+        except ValidationError as error:
+            raise ValidationError({"items": [error.detail]})
+        if reader.expect(",]") == "]":
+            return items
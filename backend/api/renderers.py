@@ -0,0 +1,43 @@
+import codecs
+
+import orjson
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from core.models import ORJSON_OPTIONS
+
+
+class ORJSONRenderer(BaseRenderer):
+    """JSONRenderer на orjson. Даты из сериализаторов приходят объектами
+    datetime (DATETIME_FORMAT = None) и кодируются самим orjson. Остальные
+    типы, которых orjson не знает, кодируются как в JSONRenderer."""
+
+    media_type = "application/json"
+    format = "json"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return orjson.dumps(
+            data, default=JSONEncoder().default, option=ORJSON_OPTIONS
+        )
+
+
+class ORJSONParser(BaseParser):
+    media_type = "application/json"
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get("encoding", settings.DEFAULT_CHARSET)
+        try:
+            data = stream.read()
+            if codecs.lookup(encoding).name != "utf-8":
+                data = data.decode(encoding)
+            return orjson.loads(data)
+        except ValueError as error:
+            raise ParseError(f"JSON parse error - {error}")
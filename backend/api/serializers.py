@@ -1,12 +1,12 @@
 from rest_framework import serializers
 from rest_framework_recursive.fields import RecursiveField
 
-from core.models import TYPE_NAME, FileSystem
+from core.models import JOB_PENDING, TYPE_NAME, FileSystem, ImportJob
 
 
 class NodesSerializer(serializers.ModelSerializer):
     type = serializers.CharField(source="get_type_display")
-    parentId = serializers.CharField(source="parent")
+    parentId = serializers.CharField(source="parent_id")
     children = RecursiveField(many=True)
 
     class Meta:
@@ -73,21 +73,42 @@ class NodesImportsSerializer(serializers.Serializer):
         raise serializers.ValidationError("Пустое значение")
 
 
-class NodesItemsUpdateSerializer(NodesItemsBaseSerializer):
-    type = serializers.CharField(source="get_type_display")
-    parentId = serializers.CharField(allow_null=True)
-
-    class Meta:
-        model = FileSystem
-        fields = ("id", "url", "date", "parentId", "size", "type")
+class DateTimeSerializer(serializers.Serializer):
+    date = serializers.DateTimeField(required=True)
 
 
-class NodesUpdateSerializer(serializers.Serializer):
-    items = NodesItemsUpdateSerializer(many=True)
+class NodesDeleteSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.CharField(), allow_empty=False
+    )
+    date = serializers.DateTimeField(required=True)
 
-    class Meta:
-        fields = ("items",)
 
+class ImportJobSerializer(serializers.ModelSerializer):
+    status = serializers.CharField(source="get_status_display")
+    items = serializers.SerializerMethodField()
+    queued = serializers.SerializerMethodField()
 
-class DateTimeSerializer(serializers.Serializer):
-    date = serializers.DateTimeField(required=True)
+    class Meta:
+        model = ImportJob
+        fields = (
+            "id",
+            "status",
+            "items",
+            "queued",
+            "error",
+            "created",
+            "started",
+            "finished",
+        )
+
+    def get_items(self, obj):
+        return len(obj.items)
+
+    def get_queued(self, obj):
+        """Сколько заданий стоит в очереди перед этим."""
+        if obj.status != JOB_PENDING:
+            return 0
+        return ImportJob.objects.filter(
+            id__lt=obj.id, status=JOB_PENDING
+        ).count()
@@ -0,0 +1,133 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from itertools import chain
+
+import orjson
+from django.db.models import Q
+
+from core.models import (
+    ORJSON_OPTIONS,
+    SNAPSHOT_FIELDS,
+    TYPE_DISPLAY,
+    TYPE_FOLDER,
+    format_date,
+    render_snapshot,
+    tree_backend,
+)
+
+SUBTREE_CHUNK_SIZE = 2000
+HISTORY_FIELDS = ("node_id", "url", "parent_id", "size", "type")
+
+
+def subtree_pages(node_id: str):
+    """Страницы строк поддерева node_id по SUBTREE_CHUNK_SIZE из движка
+    дерева, см. NestedSetTree.subtree_pages. Нет страниц, если узла нет."""
+    return tree_backend().subtree_pages(node_id, SUBTREE_CHUNK_SIZE)
+
+
+def subtree_json(pages):
+    """Отдает JSON поддерева из subtree_pages частями, следующая страница
+    читается только после отдачи предыдущей. Вложенность собирается за один
+    проход по стеку открытых папок. Готовые снимки узлов берутся из колонки
+    snapshot, остальные собираются."""
+    stack, buffer, need_comma = [], [], False
+    for snapshot, left, right, *values in chain.from_iterable(pages):
+        while stack and stack[-1] < left:
+            stack.pop()
+            buffer.append("]}")
+            need_comma = True
+        if need_comma:
+            buffer.append(",")
+        buffer.append((snapshot or render_snapshot(*values))[:-1])
+        if values[2] == TYPE_FOLDER:
+            buffer.append(',"children":[')
+            stack.append(right)
+            need_comma = False
+        else:
+            buffer.append(',"children":null}')
+            need_comma = True
+        if len(buffer) >= SUBTREE_CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer = []
+    buffer.extend("]}" for _ in stack)
+    yield "".join(buffer).encode()
+
+
+def encode_cursor(date: datetime, node_id: str) -> str:
+    cursor = orjson.dumps([date.isoformat(), node_id])
+    return urlsafe_b64encode(cursor).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Обратная к encode_cursor. ValueError для испорченного курсора."""
+    try:
+        date, node_id = orjson.loads(urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(date), str(node_id)
+    except (TypeError, ValueError) as error:
+        raise ValueError(cursor) from error
+
+
+def updates_rows(queryset, limit: int) -> list:
+    """Страница queryset, упорядоченного по (date, id), и одна строка
+    сверху, по которой видно, что страница не последняя."""
+    rows = queryset.values_list("snapshot", *SNAPSHOT_FIELDS)
+    return list(rows[: limit + 1])
+
+
+def updates_json(rows: list, limit: int):
+    """Отдает частями страницу {"items": [...], "next": cursor} из
+    updates_rows. next - курсор для следующей страницы или null, если
+    страница последняя."""
+    buffer, cursor, last = ['{"items":['], None, None
+    for number, (snapshot, *values) in enumerate(rows):
+        if number == limit:
+            cursor = encode_cursor(last[4], last[0])
+            break
+        if number:
+            buffer.append(",")
+        buffer.append(snapshot or render_snapshot(*values))
+        last = values
+        if len(buffer) >= SUBTREE_CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer = []
+    buffer.append(f'],"next":{orjson.dumps(cursor).decode()}}}')
+    yield "".join(buffer).encode()
+
+
+def history_json(queryset):
+    """Отдает {"items": [...]} для истории queryset частями по
+    SUBTREE_CHUNK_SIZE записей. Каждая часть - отдельный запрос по ключу
+    (change_date, id), так что поток между частями не держит соединение."""
+    queryset = queryset.order_by("change_date", "id").values_list(
+        "change_date", "id", *HISTORY_FIELDS
+    )
+    rows, last, prefix = None, None, b'{"items":['
+    while rows is None or len(rows) == SUBTREE_CHUNK_SIZE:
+        page = queryset
+        if last is not None:
+            page = page.filter(
+                Q(change_date__gt=last[0])
+                | Q(change_date=last[0], id__gt=last[1])
+            )
+        rows = list(page[:SUBTREE_CHUNK_SIZE])
+        if not rows:
+            break
+        yield prefix + b",".join(_history_item(*row) for row in rows)
+        last, prefix = rows[-1], b","
+    yield b"]}" if last else b'{"items":[]}'
+
+
+def _history_item(
+    change_date, history_id, node_id, url, parent_id, size, node_type
+) -> bytes:
+    return orjson.dumps(
+        dict(
+            id=node_id,
+            url=url,
+            date=format_date(change_date),
+            parentId=parent_id,
+            size=size,
+            type=TYPE_DISPLAY[node_type],
+        ),
+        option=ORJSON_OPTIONS,
+    )
@@ -0,0 +1,28 @@
+"""Синтетические данные для тестов и бенчмарков."""
+
+
+def synthetic_items(prefix: str, depth: int, fanout: int) -> list:
+    """Элементы импорта дерева: папки depth уровней по fanout детей, у
+    каждой папки по файлу. Родители всегда идут раньше детей."""
+    items = [dict(id=f"{prefix}0", parentId=None, type="FOLDER")]
+    level = [f"{prefix}0"]
+    for _ in range(depth):
+        next_level = []
+        for parent_id in level:
+            for _ in range(fanout):
+                node_id = f"{prefix}{len(items)}"
+                items.append(
+                    dict(id=node_id, parentId=parent_id, type="FOLDER")
+                )
+                next_level.append(node_id)
+            items.append(
+                dict(
+                    id=f"{prefix}{len(items)}",
+                    parentId=parent_id,
+                    url=f"/file/{len(items)}",
+                    size=len(items),
+                    type="FILE",
+                )
+            )
+        level = next_level
+    return items
@@ -1,10 +1,80 @@
-from datetime import datetime
+import json
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
+from asgiref.sync import async_to_sync
+from django.core.management import CommandError, call_command
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, connection
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+from django.test import (
+    LiveServerTestCase,
+    override_settings,
+    skipUnlessDBFeature,
+)
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.reverse import reverse
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.test import (
+    APIClient,
+    APITestCase,
+    APITransactionTestCase,
+)
 
-from core.models import TYPE_FILE, TYPE_NAME, FileSystem
+from api.asgi import ASGIHandler
+from api.cache import invalidate_nodes
+from api.jobs import claim_job, run_job
+from api.metrics import DB_QUERIES, RESPONSE_SIZE
+from api.parsers import parse_import
+from api.renderers import ORJSONRenderer
+from api.serializers import NodesItemsImportSerializer, NodesSerializer
+from api.testing import synthetic_items
+from api.validators import validate_import_item
+from core.models import (
+    TYPE_FILE,
+    TYPE_FOLDER,
+    TYPE_NAME,
+    FileSystem,
+    History,
+    ImportJob,
+    SizePropagation,
+    TreeClosure,
+    tree_backend,
+)
+from core.closure import ClosureTree
+from core.tree import NestedSetTree
+
+CLOSURE_TREE = "core.closure.ClosureTree"
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+}
+
+
+def file_caches(location: str) -> dict:
+    """Настройка CACHES с общим для процессов кэшем в каталоге location"""
+    return {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": location,
+        }
+    }
+
+
+def sort_children(node):
+    """Сортирует детей в JSON поддерева по id на всех уровнях"""
+    if isinstance(node, dict) and node.get("children"):
+        node["children"].sort(key=lambda child: child["id"])
+        for child in node["children"]:
+            sort_children(child)
+    return node
 
 
 class NodesTests(APITestCase):
@@ -40,6 +110,51 @@ class NodesTests(APITestCase):
             result[key] = value
         return result
 
+    def get_json(self, response) -> dict:
+        """Разбирает JSON как обычного, так и потокового ответа"""
+        if response.streaming:
+            return json.loads(b"".join(response.streaming_content))
+        return json.loads(response.content)
+
+    def serialized_tree(self, node_id: str) -> dict:
+        """Поддерево node_id, собранное NodesSerializer, как JSON"""
+        data = NodesSerializer(FileSystem.objects.get(id=node_id)).data
+        return json.loads(ORJSONRenderer().render(data))
+
+    def check_tree(self, root_id: str):
+        """Проверка, что движок дерева находит у корня те же потомки, что и
+        обход по parent_id, счетчики файлов и папок сходятся с потомками, а
+        nested set без дыр"""
+        root = FileSystem.objects.get(id=root_id)
+        expected, parents = {root_id}, [root_id]
+        while parents:
+            parents = list(
+                FileSystem.objects.filter(parent_id__in=parents).values_list(
+                    "id", flat=True
+                )
+            )
+            expected.update(parents)
+        nodes = root.get_descendants(include_self=True)
+        self.assertEqual(set(nodes.values_list("id", flat=True)), expected)
+        for node in nodes:
+            chain, parent_id = [], node.parent_id
+            while parent_id is not None:
+                chain.append(parent_id)
+                parent_id = FileSystem.objects.get(id=parent_id).parent_id
+            ancestors = node.get_ancestors(ascending=True)
+            self.assertEqual(
+                list(ancestors.values_list("id", flat=True)), chain
+            )
+            self.assertEqual(node.tree_id, root.tree_id)
+            self.assertEqual(node.level, len(chain))
+            types = list(node.get_descendants().values_list("type", flat=True))
+            self.assertEqual(
+                (node.file_count, node.folder_count),
+                (types.count(TYPE_FILE), types.count(TYPE_FOLDER)),
+            )
+        if isinstance(tree_backend(), NestedSetTree):
+            self.assertEqual((root.lft, root.rght), (1, len(expected) * 2))
+
     def test_create_folder_and_file(self):
         """Проверка создания папки и файла"""
         tests = [self.item_folder, self.item_file]
@@ -230,3 +345,1225 @@ class NodesTests(APITestCase):
             node1.size, node2.size + file1["size"] + file4["size"]
         )
         self.assertEqual(node1.date.strftime("%Y-%m-%dT%H:%M:%SZ"), date2)
+
+    def test_import_batch_with_parents(self):
+        """Проверка импорта дерева одной пачкой и переноса внутри пачки"""
+        items = [
+            self.get_item(node_type=1, id="batch1"),
+            self.get_item(node_type=1, id="batch2", parentId="batch1"),
+            self.get_item(node_type=2, id="bfile1", parentId="batch2", size=7),
+            self.get_item(node_type=2, id="bfile2", parentId="batch1", size=3),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        response = self.client.post(self.imports_url, import_data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(FileSystem.objects.get(id="batch1").size, 10)
+        self.assertEqual(FileSystem.objects.get(id="batch2").size, 7)
+
+        items = [
+            self.get_item(node_type=1, id="batch3", parentId="batch1"),
+            self.get_item(node_type=2, id="bfile1", parentId="batch3", size=9),
+            self.get_item(node_type=1, id="batch2", parentId="batch3"),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        response = self.client.post(self.imports_url, import_data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        batch1 = FileSystem.objects.get(id="batch1")
+        self.assertEqual(batch1.size, 12)
+        self.assertEqual(FileSystem.objects.get(id="batch2").size, 0)
+        self.assertEqual(FileSystem.objects.get(id="batch3").size, 9)
+        self.assertEqual(
+            sorted(batch1.get_descendants().values_list("id", flat=True)),
+            ["batch2", "batch3", "bfile1", "bfile2"],
+        )
+        self.assertEqual(
+            FileSystem.objects.get(id="batch2").get_ancestors().count(), 2
+        )
+
+    def test_move_recounts_sizes(self):
+        """Проверка, что перенос узла меняет размеры и счетчики только на
+        расходящихся ветках, а общие предки получают итоговое изменение"""
+        items = [
+            self.get_item(node_type=1, id="move1"),
+            self.get_item(node_type=1, id="move2", parentId="move1"),
+            self.get_item(node_type=1, id="move3", parentId="move1"),
+            self.get_item(node_type=2, id="mfile", parentId="move2", size=6),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        response = self.client.post(self.imports_url, import_data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        def move(node_id: str, target_id: str, new_size: int):
+            node = FileSystem.objects.get(id=node_id)
+            target = FileSystem.objects.get(id=target_id)
+            old_chain = node.get_ancestors(ascending=True)
+            new_chain = target.get_ancestors(ascending=True, include_self=True)
+            propagation = SizePropagation(date=node.date)
+            propagation.add_move(
+                list(old_chain.values_list("id", flat=True)),
+                list(new_chain.values_list("id", flat=True)),
+                node.size,
+                new_size,
+                *node.subtree_counts(),
+            )
+            tree_backend().move_node(node, target)
+            FileSystem.objects.filter(id=node_id).update(size=new_size)
+            propagation.save()
+
+        move("mfile", "move3", 6)
+        self.assertEqual(FileSystem.objects.get(id="move1").size, 6)
+        self.assertEqual(FileSystem.objects.get(id="move2").size, 0)
+        self.assertEqual(FileSystem.objects.get(id="move3").size, 6)
+        self.check_tree("move1")
+
+        move("mfile", "move2", 10)
+        self.assertEqual(FileSystem.objects.get(id="move1").size, 10)
+        self.assertEqual(FileSystem.objects.get(id="move2").size, 10)
+        self.assertEqual(FileSystem.objects.get(id="move3").size, 0)
+        self.check_tree("move1")
+
+    def test_import_order_is_irrelevant(self):
+        """Проверка, что дети могут идти в запросе раньше родителей, а цикл
+        внутри пачки не создает объекты"""
+        items = [
+            self.get_item(node_type=2, id="ofile", parentId="order2", size=4),
+            self.get_item(node_type=1, id="order2", parentId="order1"),
+            self.get_item(node_type=1, id="order1"),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        response = self.client.post(self.imports_url, import_data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(FileSystem.objects.get(id="order1").size, 4)
+        self.assertEqual(
+            FileSystem.objects.get(id="ofile").get_ancestors().count(), 2
+        )
+
+        items = [
+            self.get_item(node_type=1, id="cycle1", parentId="cycle2"),
+            self.get_item(node_type=1, id="cycle2", parentId="cycle1"),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        nodes_count = FileSystem.objects.count()
+        response = self.client.post(self.imports_url, import_data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(FileSystem.objects.count(), nodes_count)
+
+    def test_streaming_import(self):
+        """Проверка, что тело импорта разбирается по частям: значения,
+        разорванные границей части, читаются целиком, испорченный JSON не
+        создает объекты"""
+        items = [self.get_item(node_type=1, id="папка-stream")]
+        items.extend(
+            self.get_item(
+                node_type=2,
+                id=f"stream{number}",
+                parentId="папка-stream",
+                size=number + 1,
+            )
+            for number in range(5)
+        )
+        body = json.dumps(dict(items=items, updateDate=self.date))
+        nodes_count = FileSystem.objects.count()
+        with mock.patch("api.parsers.IMPORT_READ_SIZE", 3):
+            response = self.client.post(
+                self.imports_url, body, content_type="application/json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(FileSystem.objects.count(), nodes_count + 6)
+            self.assertEqual(
+                FileSystem.objects.get(id="папка-stream").size, 15
+            )
+
+            nodes_count = FileSystem.objects.count()
+            for broken in (body[:-1], body + "}", body.replace(":", "", 1)):
+                response = self.client.post(
+                    self.imports_url, broken, content_type="application/json"
+                )
+                self.assertEqual(
+                    response.status_code, status.HTTP_400_BAD_REQUEST
+                )
+                self.assertEqual(FileSystem.objects.count(), nodes_count)
+
+    def test_streaming_import_charset(self):
+        """Проверка, что JSON с параметрами в Content-Type тоже разбирается
+        потоком"""
+        items = [self.get_item(node_type=1, id="папка-charset")]
+        body = json.dumps(
+            dict(items=items, updateDate=self.date), ensure_ascii=False
+        )
+        with mock.patch(
+            "api.views.parse_import", wraps=parse_import
+        ) as parse:
+            response = self.client.post(
+                self.imports_url,
+                body.encode("cp1251"),
+                content_type="Application/JSON; charset=windows-1251",
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(parse.called)
+        self.assertTrue(FileSystem.objects.filter(id="папка-charset").exists())
+
+    def test_import_validator(self):
+        """Проверка, что validate_import_item принимает и отклоняет те же
+        элементы, что и NodesItemsImportSerializer"""
+        serializer = NodesItemsImportSerializer()
+        values = (None, 0, 3, 3.0, 3.5, " 3 ", "", " ", "a\x00", True, [])
+        for key in ("id", "url", "parentId", "size", "type"):
+            for node_type in (1, 2):
+                for value in values + ("FILE", "a" * 256):
+                    item = self.get_item(node_type=node_type, **{key: value})
+                    with self.subTest(item=item):
+                        try:
+                            expected = dict(serializer.run_validation(item))
+                        except ValidationError:
+                            expected = None
+                        try:
+                            result = validate_import_item(item)
+                        except ValidationError:
+                            result = None
+                        self.assertEqual(result, expected)
+
+    @override_settings(IMPORT_REBUILD_MOVES=1)
+    def test_import_moves_in_rebuild_mode(self):
+        """Проверка переносов в режиме пересчета дерева целиком"""
+        items = [
+            self.get_item(node_type=1, id="tree1"),
+            self.get_item(node_type=1, id="tree2"),
+            self.get_item(node_type=1, id="tree3", parentId="tree1"),
+            self.get_item(node_type=2, id="tfile1", parentId="tree3", size=2),
+            self.get_item(node_type=2, id="tfile2", parentId="tree2", size=5),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        response = self.client.post(self.imports_url, import_data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        items = [
+            self.get_item(node_type=1, id="tree2", parentId="tree3"),
+            self.get_item(node_type=2, id="tfile1", parentId="tree1", size=2),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        response = self.client.post(self.imports_url, import_data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        tree1 = FileSystem.objects.get(id="tree1")
+        self.assertEqual(tree1.size, 7)
+        self.assertEqual(FileSystem.objects.get(id="tree3").size, 5)
+        self.assertEqual(tree1.get_descendants().count(), 4)
+        self.check_tree("tree1")
+        self.assertEqual(
+            list(
+                FileSystem.objects.get(id="tfile2")
+                .get_ancestors()
+                .values_list("id", flat=True)
+            ),
+            ["tree1", "tree3", "tree2"],
+        )
+
+    @override_settings(IMPORT_REBUILD_MOVES=2)
+    def test_moves_below_common_ancestor(self):
+        """Проверка, что переносы меняют только папки ниже общего предка, а
+        переносы одной пачки применяются вместе и не затрагивают узлы вне
+        его поддерева"""
+        items = [
+            self.get_item(node_type=1, id="lca0"),
+            self.get_item(node_type=1, id="lca1", parentId="lca0"),
+            self.get_item(node_type=1, id="lca2", parentId="lca1"),
+            self.get_item(node_type=1, id="lca3", parentId="lca1"),
+            self.get_item(node_type=1, id="lca4", parentId="lca0"),
+            self.get_item(node_type=2, id="lfile1", parentId="lca2", size=3),
+            self.get_item(node_type=2, id="lfile2", parentId="lca2", size=4),
+            self.get_item(node_type=2, id="lfile3", parentId="lca4", size=5),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        response = self.client.post(self.imports_url, import_data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        url = reverse("api:nodes-detail", args=["lca0"])
+        self.get_json(self.client.get(url))
+        outside = FileSystem.objects.filter(
+            id__in=("lca4", "lfile3")
+        ).order_by("id")
+        positions = list(outside.values_list("id", "lft", "rght"))
+
+        items = [
+            self.get_item(node_type=2, id="lfile1", parentId="lca3", size=3),
+            self.get_item(node_type=2, id="lfile2", parentId="lca3", size=4),
+        ]
+        date = datetime(2022, 9, 4, 11, 10).strftime("%Y-%m-%dT%H:%M:%SZ")
+        import_data = dict(items=items, updateDate=date)
+        response = self.client.post(self.imports_url, import_data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        nodes = FileSystem.objects.in_bulk(["lca0", "lca1", "lca2", "lca3"])
+        self.assertEqual(
+            [nodes[node_id].size for node_id in ("lca0", "lca1", "lca2")],
+            [12, 7, 0],
+        )
+        self.assertEqual(nodes["lca3"].size, 7)
+        for node_id in ("lca0", "lca1"):
+            self.assertEqual(
+                nodes[node_id].date.strftime("%Y-%m-%dT%H:%M:%SZ"), self.date
+            )
+            history = History.objects.filter(node_id=node_id)
+            self.assertEqual(history.count(), 1)
+        for node_id in ("lca2", "lca3"):
+            self.assertEqual(
+                nodes[node_id].date.strftime("%Y-%m-%dT%H:%M:%SZ"), date
+            )
+        self.check_tree("lca0")
+        self.assertEqual(
+            list(outside.values_list("id", "lft", "rght")), positions
+        )
+        tree = sort_children(self.get_json(self.client.get(url)))
+        self.assertEqual(tree, sort_children(self.serialized_tree("lca0")))
+
+    def test_get_node_tree(self):
+        """Проверка, что дерево элемента отдается целиком и совпадает с
+        сериализатором"""
+        items = [
+            self.get_item(node_type=1, id="get1"),
+            self.get_item(node_type=1, id="get2", parentId="get1"),
+            self.get_item(node_type=1, id="get3", parentId="get1"),
+            self.get_item(node_type=2, id="gfile1", parentId="get2", size=3),
+            self.get_item(node_type=2, id="gfile2", parentId="get1", size=4),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        response = self.client.post(self.imports_url, import_data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(reverse("api:nodes-detail", args=["get1"]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        tree = self.get_json(response)
+        self.assertEqual(tree, self.serialized_tree("get1"))
+        self.assertEqual(tree["size"], 7)
+        self.assertIsNone(tree["children"][0]["children"][0]["children"])
+        self.assertEqual(tree["children"][1]["children"], [])
+
+        response = self.client.get(reverse("api:nodes-detail", args=["none"]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_node_tree_pages(self):
+        """Проверка, что поддерево читается страницами и следующая страница
+        запрашивается только после отдачи предыдущей части"""
+        items = [
+            self.get_item(node_type=1, id="page1"),
+            self.get_item(node_type=1, id="page2", parentId="page1"),
+            self.get_item(node_type=2, id="pfile1", parentId="page2", size=3),
+            self.get_item(node_type=2, id="pfile2", parentId="page2", size=4),
+            self.get_item(node_type=2, id="pfile3", parentId="page1", size=5),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+        url = reverse("api:nodes-detail", args=["page1"])
+
+        with mock.patch("api.streaming.SUBTREE_CHUNK_SIZE", 2):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+                chunks = iter(response.streaming_content)
+                body = next(chunks)
+                queries = len(context.captured_queries)
+                body += b"".join(chunks)
+        self.assertGreater(len(context.captured_queries), queries)
+        self.assertEqual(json.loads(body), self.serialized_tree("page1"))
+        self.assertEqual(json.loads(body)["size"], 12)
+
+    def test_nodes_list(self):
+        """Проверка, что /nodes отдает все деревья так же, как сериализатор"""
+        items = [
+            self.get_item(node_type=1, id="list1"),
+            self.get_item(node_type=1, id="list2", parentId="list1"),
+            self.get_item(node_type=2, id="lfile1", parentId="list2", size=3),
+            self.get_item(node_type=1, id="list3"),
+            self.get_item(node_type=2, id="lfile2", parentId="list3", size=4),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+
+        response = self.client.get(reverse("api:nodes-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        trees = [sort_children(tree) for tree in self.get_json(response)]
+        expected = [
+            sort_children(self.serialized_tree(node.id))
+            for node in FileSystem.objects.root_nodes()
+        ]
+        self.assertEqual(trees, expected)
+        self.assertEqual([tree["size"] for tree in trees], [3, 4])
+
+    def test_read_views_methods(self):
+        """Проверка, что обработчики чтения отвечают на HEAD, а на POST и
+        DELETE - JSON 405, даже когда клиент проверяет CSRF"""
+        items = [self.get_item(node_type=1, id="method1")]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+        urls = [
+            reverse("api:nodes-detail", args=["method1"]),
+            f"{reverse('api:updates-list')}?date={self.date}",
+            reverse("api:history-list", args=["method1"]),
+            reverse("api:stats-detail", args=["method1"]),
+        ]
+        client = APIClient(enforce_csrf_checks=True)
+        for url in urls:
+            with self.subTest(url=url):
+                response = client.head(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                for method in ("post", "delete"):
+                    response = getattr(client, method)(url)
+                    self.assertEqual(
+                        response.status_code,
+                        status.HTTP_405_METHOD_NOT_ALLOWED,
+                    )
+                    self.assertEqual(
+                        json.loads(response.content),
+                        dict(
+                            code=405,
+                            message=f'Method "{method.upper()}" not allowed.',
+                        ),
+                    )
+
+    def test_get_node_cache(self):
+        """Проверка, что ответ берется из кэша и сбрасывается при импорте и
+        удалении в поддереве"""
+        items = [
+            self.get_item(node_type=1, id="cache1"),
+            self.get_item(node_type=1, id="cache2", parentId="cache1"),
+            self.get_item(node_type=2, id="cfile", parentId="cache2", size=3),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+        url = reverse("api:nodes-detail", args=["cache1"])
+
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(self.get_json(response)["size"], 3)
+        response = self.client.get(url)
+        self.assertFalse(response.streaming)
+        self.assertEqual(self.get_json(response)["size"], 3)
+
+        items = [self.get_item(node_type=2, id="cfile", parentId="cache2")]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+        response = self.client.get(url)
+        self.assertEqual(self.get_json(response)["size"], 1)
+
+        delete_url = reverse("api:delete-detail", args=["cache2"])
+        self.client.delete(f"{delete_url}?date={self.date}")
+        tree = self.get_json(self.client.get(url))
+        self.assertEqual((tree["size"], tree["children"]), (0, []))
+
+    @override_settings(NODES_SNAPSHOTS=True)
+    def test_node_snapshots(self):
+        """Проверка, что снимки узлов обновляются при записи и отдаются в
+        дереве так же, как без них"""
+        items = [
+            self.get_item(node_type=1, id="snap1"),
+            self.get_item(node_type=1, id="snap2", parentId="snap1"),
+            self.get_item(node_type=2, id="sfile", parentId="snap2", size=3),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+        items = [self.get_item(node_type=2, id="sfile", parentId="snap1")]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+
+        for node in FileSystem.objects.filter(id__startswith="s"):
+            with self.subTest(id=node.id):
+                self.assertEqual(node.snapshot, node.render_snapshot())
+        response = self.client.get(reverse("api:nodes-detail", args=["snap1"]))
+        self.assertEqual(
+            self.get_json(response), self.serialized_tree("snap1")
+        )
+
+    def test_node_history(self):
+        """Проверка истории файла за полуинтервал и за всё время"""
+        url = reverse("api:history-list", args=["hfile"])
+        for day, size in ((1, 2), (2, 4), (3, 8)):
+            items = [self.get_item(node_type=2, id="hfile", size=size)]
+            update_date = datetime(2022, 9, day).strftime("%Y-%m-%dT%H:%M:%SZ")
+            import_data = dict(items=items, updateDate=update_date)
+            self.client.post(self.imports_url, import_data)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        items = self.get_json(response)["items"]
+        self.assertEqual([item["size"] for item in items], [2, 4, 8])
+        dates = dict(
+            dateStart="2022-09-02T00:00:00Z", dateEnd="2022-09-03T00:00:00Z"
+        )
+        response = self.client.get(url, dates)
+        self.assertEqual(
+            self.get_json(response)["items"],
+            [
+                dict(
+                    id="hfile",
+                    url=self.item_file["url"],
+                    date="2022-09-02T00:00:00Z",
+                    parentId=None,
+                    size=4,
+                    type="FILE",
+                )
+            ],
+        )
+        dates = dict(
+            dateStart="2022-09-02T00:00:00.000Z",
+            dateEnd="2022-09-03T00:00:00.500+00:00",
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", RuntimeWarning)
+            response = self.client.get(url, dates)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        items = self.get_json(response)["items"]
+        self.assertEqual([item["size"] for item in items], [4, 8])
+
+    def test_folder_history(self):
+        """Проверка, что импорт пишет в историю и изменившиеся папки-предки"""
+        items = [
+            self.get_item(node_type=1, id="hist1"),
+            self.get_item(node_type=1, id="hist2", parentId="hist1"),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+        items = [
+            self.get_item(node_type=2, id="hfile1", parentId="hist2", size=5)
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+
+        response = self.client.get(reverse("api:history-list", args=["hist1"]))
+        items = self.get_json(response)["items"]
+        self.assertEqual(
+            [(item["size"], item["type"]) for item in items],
+            [(0, "FOLDER"), (5, "FOLDER")],
+        )
+        response = self.client.get(reverse("api:history-list", args=["hist2"]))
+        items = self.get_json(response)["items"]
+        self.assertEqual(items[-1]["parentId"], "hist1")
+        self.assertEqual(items[-1]["size"], 5)
+
+    def test_node_stats(self):
+        """Проверка, что счетчики файлов и папок в поддереве меняются при
+        вставке, переносе и удалении и отдаются в /node/{id}/stats"""
+        items = [
+            self.get_item(node_type=1, id="stat1"),
+            self.get_item(node_type=1, id="stat2", parentId="stat1"),
+            self.get_item(node_type=1, id="stat3", parentId="stat2"),
+            self.get_item(node_type=2, id="sfile1", parentId="stat3", size=3),
+            self.get_item(node_type=2, id="sfile2", parentId="stat2", size=5),
+            self.get_item(node_type=1, id="stat4", parentId="stat1"),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+        response = self.client.get(reverse("api:stats-detail", args=["stat1"]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            self.get_json(response),
+            dict(
+                id="stat1",
+                type="FOLDER",
+                date=self.date,
+                size=8,
+                fileCount=2,
+                folderCount=3,
+            ),
+        )
+
+        items = [self.get_item(node_type=1, id="stat3", parentId="stat4")]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+        counts = {
+            node.id: (node.file_count, node.folder_count)
+            for node in FileSystem.objects.filter(id__startswith="stat")
+        }
+        self.assertEqual(
+            counts,
+            dict(stat1=(2, 3), stat2=(1, 0), stat3=(1, 0), stat4=(1, 1)),
+        )
+
+        delete_url = reverse("api:delete-detail", args=["stat4"])
+        self.client.delete(f"{delete_url}?date={self.date}")
+        self.check_tree("stat1")
+        response = self.client.get(reverse("api:stats-detail", args=["stat1"]))
+        self.assertEqual(self.get_json(response)["fileCount"], 1)
+        self.assertEqual(self.get_json(response)["folderCount"], 1)
+        response = self.client.get(reverse("api:stats-detail", args=["none"]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_asgi_node_tree(self):
+        """Проверка, что под ASGI поддерево отдается асинхронным потоком"""
+        items = [
+            self.get_item(node_type=1, id="asgi1"),
+            self.get_item(node_type=2, id="asgi2", parentId="asgi1", size=3),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+
+        scope = dict(
+            type="http",
+            asgi={"version": "3.0"},
+            http_version="1.1",
+            method="GET",
+            scheme="http",
+            path=reverse("api:nodes-detail", args=["asgi1"]),
+            root_path="",
+            query_string=b"",
+            headers=[],
+            server=("testserver", 80),
+            client=("127.0.0.1", 0),
+        )
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        queries = DB_QUERIES.get(("nodes-detail", "GET"))
+        # Как и тестовый клиент, не даем закрыть соединение с транзакцией.
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            async_to_sync(ASGIHandler())(scope, receive, send)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+        self.assertEqual(messages[0]["status"], status.HTTP_200_OK)
+        self.assertTrue(messages[1]["more_body"])
+        body = b"".join(message.get("body", b"") for message in messages[1:])
+        tree = json.loads(body)
+        self.assertEqual(tree["size"], 3)
+        self.assertEqual(tree["children"][0]["id"], "asgi2")
+        count, total = DB_QUERIES.get(("nodes-detail", "GET"))
+        self.assertEqual(count, queries[0] + 1)
+        self.assertGreater(total, queries[1])
+
+    @override_settings(UPDATES_PAGE_SIZE=2)
+    def test_updates_pages(self):
+        """Проверка, что /updates отдает файлы за сутки страницами по
+        курсору"""
+        url = reverse("api:updates-list")
+        for hour in range(5):
+            items = [self.get_item(node_type=2, id=f"upd{hour}", size=1)]
+            update_date = datetime(2022, 10, 1, hour).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            )
+            import_data = dict(items=items, updateDate=update_date)
+            self.client.post(self.imports_url, import_data)
+
+        query = dict(date="2022-10-02T01:00:00Z")
+        ids = []
+        while True:
+            response = self.client.get(url, query)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            page = self.get_json(response)
+            self.assertLessEqual(len(page["items"]), 2)
+            ids.extend(item["id"] for item in page["items"])
+            if page["next"] is None:
+                break
+            query["cursor"] = page["next"]
+        self.assertEqual(ids, ["upd1", "upd2", "upd3", "upd4"])
+
+        query = dict(date="2022-10-02T01:00:00Z", limit=1)
+        page = self.get_json(self.client.get(url, query))
+        self.assertEqual(page["items"][0]["id"], "upd1")
+        self.assertEqual(page["items"][0]["parentId"], None)
+        query["cursor"] = "bad"
+        response = self.client.get(url, query)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for limit in ("0", "-1", "x", "²", "١"):
+            with self.subTest(limit=limit):
+                query = dict(date="2022-10-02T01:00:00Z", limit=limit)
+                response = self.client.get(url, query)
+                self.assertEqual(
+                    response.status_code, status.HTTP_400_BAD_REQUEST
+                )
+
+    def test_delete_subtree(self):
+        """Проверка удаления папки с поддеревом: размеры предков, история,
+        nested set оставшегося дерева и кэш ответов удаленных потомков"""
+        items = [
+            self.get_item(node_type=1, id="del1"),
+            self.get_item(node_type=1, id="del2", parentId="del1"),
+            self.get_item(node_type=1, id="del3", parentId="del2"),
+            self.get_item(node_type=2, id="dfile1", parentId="del3", size=4),
+            self.get_item(node_type=2, id="dfile2", parentId="del2", size=2),
+            self.get_item(node_type=2, id="dfile3", parentId="del1", size=1),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+        child_url = reverse("api:nodes-detail", args=["del3"])
+        response = self.client.get(child_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.get_json(response)
+        self.assertEqual(
+            self.client.get(child_url).status_code, status.HTTP_200_OK
+        )
+
+        delete_url = reverse("api:delete-detail", args=["del2"])
+        response = self.client.delete(f"{delete_url}?date={self.date}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(child_url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        root = FileSystem.objects.get(id="del1")
+        self.assertEqual(root.size, 1)
+        self.check_tree("del1")
+        self.assertEqual(
+            list(root.get_descendants().values_list("id", flat=True)),
+            ["dfile3"],
+        )
+        self.assertFalse(
+            History.objects.filter(
+                node_id__in=("del2", "del3", "dfile1", "dfile2")
+            ).exists()
+        )
+
+        response = self.client.delete(f"{delete_url}?date={self.date}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_delete_batch(self):
+        """Проверка пакетного удаления: вложенные id отбрасываются, размер
+        общего предка уменьшается один раз на сумму, nested set цел"""
+        items = [
+            self.get_item(node_type=1, id="bdel1"),
+            self.get_item(node_type=1, id="bdel2", parentId="bdel1"),
+            self.get_item(node_type=2, id="bfile1", parentId="bdel2", size=4),
+            self.get_item(node_type=2, id="bfile2", parentId="bdel1", size=2),
+            self.get_item(node_type=2, id="bfile3", parentId="bdel1", size=1),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+
+        batch_url = reverse("api:delete-list")
+        response = self.client.post(
+            batch_url,
+            dict(ids=["bdel2", "bfile1", "bfile2"], date=self.date),
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        root = FileSystem.objects.get(id="bdel1")
+        self.assertEqual(root.size, 1)
+        self.check_tree("bdel1")
+        self.assertEqual(
+            list(root.get_descendants().values_list("id", flat=True)),
+            ["bfile3"],
+        )
+
+        response = self.client.post(
+            batch_url, dict(ids=["bfile3", "bdel2"], date=self.date)
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertTrue(FileSystem.objects.filter(id="bfile3").exists())
+
+    def test_delete_node_named_batch(self):
+        """Проверка, что узел с id batch удаляется через /delete/{id}, а не
+        попадает в пакетное удаление"""
+        items = [self.get_item(node_type=1, id="batch")]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+
+        delete_url = reverse("api:delete-detail", args=["batch"])
+        response = self.client.delete(f"{delete_url}?date={self.date}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(FileSystem.objects.filter(id="batch").exists())
+
+    def test_async_import(self):
+        """Проверка отложенного импорта: задание ставится в очередь, импорт в
+        папку из более раннего задания ждет его, ошибки видны в статусе"""
+        items = [self.get_item(node_type=1, id="async1")]
+        response = self.client.post(
+            f"{self.imports_url}?async=true",
+            dict(items=items, updateDate=self.date),
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        first = response.data
+        self.assertEqual(first["status"], "PENDING")
+        self.assertFalse(FileSystem.objects.filter(id="async1").exists())
+
+        items = [
+            self.get_item(node_type=2, id="async2", parentId="async1", size=3)
+        ]
+        self.client.post(
+            f"{self.imports_url}?async=true",
+            dict(items=items, updateDate=self.date),
+        )
+        items = [self.get_item(node_type=2, id="async3", parentId="missing")]
+        failed = self.client.post(
+            f"{self.imports_url}?async=true",
+            dict(items=items, updateDate=self.date),
+        ).data
+        job = claim_job()
+        self.assertEqual(job.id, first["id"])
+        self.assertEqual(claim_job().id, failed["id"])
+        run_job(job)
+        run_job(ImportJob.objects.get(id=failed["id"]))
+
+        with override_settings(CACHES=LOCMEM_CACHES):
+            with self.assertRaises(CommandError):
+                call_command("import_worker", "--once", "--processes", "1")
+        with TemporaryDirectory() as location:
+            with override_settings(CACHES=file_caches(location)):
+                call_command("import_worker", "--once", "--processes", "1")
+        self.assertEqual(FileSystem.objects.get(id="async1").size, 3)
+        status_url = reverse("api:imports-detail", args=[first["id"]])
+        response = self.client.get(status_url)
+        self.assertEqual(response.data["status"], "DONE")
+        status_url = reverse("api:imports-detail", args=[failed["id"]])
+        response = self.client.get(status_url)
+        self.assertEqual(response.data["status"], "FAILED")
+        self.assertEqual(response.data["error"]["code"], 404)
+
+    def test_switch_tree_backend(self):
+        """Проверка, что после смены движка дерева туда и обратно
+        rebuild_tree восстанавливает его структуру по parent_id, а связи
+        таблицы замыкания не мешают удалению"""
+        items = [
+            self.get_item(node_type=1, id="sw1"),
+            self.get_item(node_type=1, id="sw2", parentId="sw1"),
+            self.get_item(node_type=1, id="sw3", parentId="sw2"),
+            self.get_item(node_type=2, id="swfile", parentId="sw3", size=2),
+        ]
+        import_data = dict(items=items, updateDate=self.date)
+        self.client.post(self.imports_url, import_data)
+        for backend in (CLOSURE_TREE, "core.tree.NestedSetTree"):
+            with self.subTest(backend=backend), override_settings(
+                TREE_BACKEND=backend
+            ):
+                call_command("rebuild_tree", stdout=StringIO())
+                self.check_tree("sw1")
+                items = [self.get_item(node_type=1, id="sw3", parentId="sw1")]
+                import_data = dict(items=items, updateDate=self.date)
+                self.client.post(self.imports_url, import_data)
+                items[0]["parentId"] = "sw2"
+                self.client.post(self.imports_url, import_data)
+                self.check_tree("sw1")
+                self.assertEqual(FileSystem.objects.get(id="sw2").size, 2)
+
+        self.assertFalse(TreeClosure.objects.exists())
+        delete_url = reverse("api:delete-detail", args=["sw3"])
+        with override_settings(TREE_BACKEND="core.tree.NestedSetTree"):
+            response = self.client.delete(f"{delete_url}?date={self.date}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_check_sizes(self):
+        """Проверка, что check_sizes находит разошедшиеся размер, счетчики и
+        дату папок, а с --fix исправляет их и сбрасывает кэш предков"""
+        items = [
+            self.get_item(node_type=1, id="chk1"),
+            self.get_item(node_type=1, id="chk2", parentId="chk1"),
+            self.get_item(node_type=1, id="chk3", parentId="chk2"),
+            self.get_item(node_type=2, id="cfile1", parentId="chk3", size=4),
+            self.get_item(node_type=2, id="cfile2", parentId="chk1", size=1),
+        ]
+        import_data = dict(items=items, updateDate="2022-09-02T00:00:00Z")
+        self.client.post(self.imports_url, import_data)
+        url = reverse("api:nodes-detail", args=["chk1"])
+        expected = self.get_json(self.client.get(url))
+        FileSystem.objects.filter(id="chk3").update(
+            size=1,
+            file_count=0,
+            date=datetime(2022, 9, 1, tzinfo=timezone.utc),
+            snapshot=None,
+        )
+        FileSystem.objects.filter(id="chk2").update(folder_count=5)
+        invalidate_nodes(["chk1"])
+        self.assertNotEqual(self.get_json(self.client.get(url)), expected)
+
+        out = StringIO()
+        call_command("check_sizes", stdout=out)
+        self.assertEqual(
+            out.getvalue().splitlines()[-3:],
+            [
+                f"Дерево {FileSystem.objects.get(id='chk1').tree_id}, chk3: "
+                "size 1 -> 4, file_count 0 -> 1, "
+                "date 2022-09-01T00:00:00Z -> 2022-09-02T00:00:00Z",
+                f"Дерево {FileSystem.objects.get(id='chk1').tree_id}, chk2: "
+                "folder_count 5 -> 1",
+                "Деревьев: 1, расхождений найдено: 2",
+            ],
+        )
+        self.assertEqual(FileSystem.objects.get(id="chk3").size, 1)
+
+        call_command("check_sizes", "--fix", stdout=StringIO())
+        self.check_tree("chk1")
+        self.assertEqual(self.get_json(self.client.get(url)), expected)
+        out = StringIO()
+        call_command("check_sizes", stdout=out)
+        self.assertIn("расхождений найдено: 0", out.getvalue())
+
+
+@override_settings(TREE_BACKEND=CLOSURE_TREE)
+class ClosureNodesTests(NodesTests):
+    """Те же проверки на таблице замыкания. Порядок братьев она не
+    хранит, поэтому дети в поддеревьях сравниваются по порядку id"""
+
+    def get_json(self, response) -> dict:
+        return sort_children(super().get_json(response))
+
+    def serialized_tree(self, node_id: str) -> dict:
+        return sort_children(super().serialized_tree(node_id))
+
+    def check_tree(self, root_id: str):
+        super().check_tree(root_id)
+        if not isinstance(tree_backend(), ClosureTree):
+            return
+        nodes = FileSystem.objects.get(id=root_id).get_descendants(
+            include_self=True
+        )
+        links = TreeClosure.objects.filter(descendant__in=nodes)
+        self.assertEqual(
+            links.count(), sum(node.level + 1 for node in nodes)
+        )
+
+
+class MetricsTests(APITestCase):
+    def test_request_metrics(self):
+        """Проверка, что запросы к базе и размер ответа считаются по
+        эндпоинтам и отдаются в /metrics"""
+        labels = ("nodes-detail", "GET")
+        queries, size = DB_QUERIES.get(labels), RESPONSE_SIZE.get(labels)
+        items = [dict(id="metric1", type="FOLDER", parentId=None)]
+        import_data = dict(items=items, updateDate="2022-09-01T00:00:00Z")
+        self.client.post(reverse("api:imports-list"), import_data)
+        response = self.client.get(
+            reverse("api:nodes-detail", args=["metric1"])
+        )
+        body = b"".join(response.streaming_content)
+
+        count, total = DB_QUERIES.get(labels)
+        self.assertEqual(count, queries[0] + 1)
+        self.assertEqual(total, queries[1] + 1)
+        self.assertEqual(RESPONSE_SIZE.get(labels)[1], size[1] + len(body))
+        response = self.client.get(reverse("api:metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(
+            'enrollment_db_queries_count{endpoint="imports-list",'
+            'method="POST"}',
+            response.content.decode(),
+        )
+
+    @override_settings(METRICS_SLOW_REQUEST_MS=0.001)
+    def test_slow_request_log(self):
+        """Проверка, что медленный запрос пишется в лог с разбивкой по SQL"""
+        url = reverse("api:delete-detail", args=["none"])
+        with self.assertLogs("api.metrics", "WARNING") as logs:
+            self.client.delete(f"{url}?date=2022-09-01T00:00:00Z")
+        self.assertIn("DELETE /delete/none", logs.output[0])
+        self.assertIn("status 404, 1 queries", logs.output[0])
+        self.assertIn("1 x", logs.output[0])
+        self.assertIn('SELECT "core_filesystem"', logs.output[0])
+
+
+@skipUnlessDBFeature("has_select_for_update")
+class ConcurrentImportsTests(LiveServerTestCase):
+    """Параллельные импорты в живой сервер. Потоки переносят свои папки между
+    общими деревьями, поэтому блокировки берутся в разном сочетании.
+    Только для баз с блокировками строк: SQLite пишет последовательно."""
+
+    threads = 8
+    imports = 10
+    trees = 4
+    date = "2022-09-01T10:00:00Z"
+
+    def post(self, data: dict) -> int:
+        request = Request(
+            f"{self.live_server_url}/imports",
+            data=json.dumps(data).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        try:
+            with urlopen(request) as response:
+                return response.status
+        except HTTPError as error:
+            return error.code
+
+    def get_item(self, node_type: str, **kwargs) -> dict:
+        item = dict(url=None, parentId=None, size=None, type=node_type)
+        item.update(kwargs)
+        return item
+
+    def run_imports(self, thread: int) -> list:
+        statuses = []
+        folder = f"stress-folder-{thread}"
+        for number in range(self.imports):
+            tree = f"stress-tree-{(thread + number) % self.trees}"
+            items = [
+                self.get_item("FOLDER", id=folder, parentId=tree),
+                self.get_item(
+                    "FILE",
+                    id=f"stress-file-{thread}-{number}",
+                    url="stress/file",
+                    parentId=folder,
+                    size=number + 1,
+                ),
+            ]
+            statuses.append(self.post(dict(items=items, updateDate=self.date)))
+        return statuses
+
+    def test_concurrent_imports(self):
+        """Проверка, что параллельные импорты проходят без ошибок, а размеры
+        и nested set всех деревьев после них согласованы"""
+        roots = [
+            self.get_item("FOLDER", id=f"stress-tree-{tree}")
+            for tree in range(self.trees)
+        ]
+        status_code = self.post(dict(items=roots, updateDate=self.date))
+        self.assertEqual(status_code, status.HTTP_200_OK)
+
+        with ThreadPoolExecutor(self.threads) as pool:
+            results = pool.map(self.run_imports, range(self.threads))
+            statuses = {code for codes in results for code in codes}
+        self.assertEqual(statuses, {status.HTTP_200_OK})
+
+        files = FileSystem.objects.filter(type=TYPE_FILE)
+        self.assertEqual(files.count(), self.threads * self.imports)
+        for root in FileSystem.objects.filter(parent=None):
+            nodes = root.get_descendants(include_self=True)
+            self.assertEqual(root.rght, nodes.count() * 2)
+            size = nodes.filter(type=TYPE_FILE).aggregate(Sum("size"))
+            self.assertEqual(root.size, size["size__sum"] or 0)
+
+
+@skipUnlessDBFeature("has_select_for_update")
+class WorkerCacheTests(APITransactionTestCase):
+    """Отложенный импорт в процессах воркера при общем кэше. Только для баз
+    с блокировками строк: на SQLite воркер работает в одном процессе."""
+
+    date = "2022-09-01T10:00:00Z"
+
+    def test_worker_invalidates_cache(self):
+        """Проверка, что импорт в процессе воркера сбрасывает ответ, который
+        процесс сервера положил в кэш"""
+        url = reverse("api:nodes-detail", args=["wcache1"])
+        items = [
+            dict(id="wcache1", type="FOLDER", url=None, parentId=None),
+            dict(
+                id="wfile1",
+                type="FILE",
+                url="file1",
+                parentId="wcache1",
+                size=1,
+            ),
+        ]
+        with TemporaryDirectory() as location:
+            with override_settings(CACHES=file_caches(location)):
+                self.client.post(
+                    reverse("api:imports-list"),
+                    dict(items=items, updateDate=self.date),
+                    format="json",
+                )
+                b"".join(self.client.get(url).streaming_content)
+                response = self.client.get(url)
+                self.assertFalse(response.streaming)
+
+                items = [
+                    dict(
+                        id="wfile2",
+                        type="FILE",
+                        url="file2",
+                        parentId="wcache1",
+                        size=2,
+                    )
+                ]
+                response = self.client.post(
+                    f"{reverse('api:imports-list')}?async=true",
+                    dict(items=items, updateDate=self.date),
+                    format="json",
+                )
+                self.assertEqual(
+                    response.status_code, status.HTTP_202_ACCEPTED
+                )
+                call_command("import_worker", "--once", "--processes", "2")
+
+                response = self.client.get(url)
+                self.assertTrue(response.streaming)
+                body = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(body["size"], 3)
+
+
+class QueryCountTests(APITestCase):
+    """Число SQL-запросов на эндпоинт как функция размера запроса. Каждый
+    эндпоинт замеряется на малом и большом дереве; запросов должно быть не
+    больше base + per_item * элементов по limits, а при per_item = 0 -
+    поровну на обоих деревьях. С QUERY_COUNT_REPORT=<файл> замеры
+    записываются в этот файл как JSON.
+
+    Большое дерево помещается в одну пачку bulk_create и на SQLite, иначе
+    число запросов зависело бы от ограничения на число параметров"""
+
+    backend = "nested_set"
+    shapes = dict(small=(2, 2), large=(3, 3))
+    # Записи считаются с advisory-блокировкой PostgreSQL, на SQLite их на
+    # запрос меньше.
+    limits = dict(
+        imports=(9, 0),
+        imports_update=(9, 0),
+        imports_moves=(14, 0),
+        nodes=(1, 0),
+        nodes_list=(1, 0),
+        updates=(1, 0),
+        history=(2, 0),
+        stats=(1, 0),
+        delete=(11, 0),
+        delete_batch=(11, 0),
+    )
+    dates = dict(small="2022-09-01T00:00:00Z", large="2022-09-03T00:00:00Z")
+    measured = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        path = os.getenv("QUERY_COUNT_REPORT")
+        if path:
+            with open(path, "w") as file:
+                json.dump(cls.measured, file, indent=2, sort_keys=True)
+
+    def request(self, method: str, path: str, data: dict = None) -> list:
+        """Выполняет запрос и дочитывает потоковый ответ. Возвращает
+        выполненные SQL-запросы"""
+        with CaptureQueriesContext(connection) as context:
+            if method == "get":
+                response = self.client.get(path, data)
+            else:
+                response = getattr(self.client, method)(path, data)
+            if response.streaming:
+                b"".join(response.streaming_content)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [query["sql"] for query in context.captured_queries]
+
+    def measure(self, name: str, shape: str, items: int, *args):
+        """Замер эндпоинта name на дереве shape, items - число элементов,
+        которыми измеряется размер запроса"""
+        queries = self.request(*args)
+        endpoint = self.measured.setdefault(self.backend, {}).setdefault(
+            name, dict(limit=self.limits[name])
+        )
+        endpoint[shape] = dict(items=items, queries=len(queries))
+        base, per_item = self.limits[name]
+        self.assertLessEqual(
+            len(queries),
+            base + per_item * items,
+            f"{name} на {items} элементах:\n" + "\n".join(queries),
+        )
+        if per_item == 0 and shape == "large":
+            self.assertEqual(
+                endpoint["small"]["queries"],
+                endpoint["large"]["queries"],
+                f"{name}: число запросов растет с размером запроса",
+            )
+
+    def import_trees(self, name: str = None, action=None) -> dict:
+        """Импортирует малое, затем большое дерево, каждое со своей датой.
+        action(shape, items) вызывается после импорта каждого дерева"""
+        trees = {}
+        for shape, (depth, fanout) in self.shapes.items():
+            items = synthetic_items(shape, depth, fanout)
+            trees[shape] = items
+            data = dict(items=items, updateDate=self.dates[shape])
+            if name:
+                self.measure(name, shape, len(items), "post", "/imports", data)
+            else:
+                self.request("post", "/imports", data)
+            if action:
+                action(shape, items)
+        return trees
+
+    def deepest(self, items: list) -> list:
+        """Элементы нижнего уровня дерева"""
+        depth = {None: -1}
+        for item in items:
+            depth[item["id"]] = depth[item["parentId"]] + 1
+        bottom = max(depth.values())
+        return [item for item in items if depth[item["id"]] == bottom]
+
+    def test_imports(self):
+        """Проверка, что импорт нового дерева и обновление его файлов идут
+        за постоянное число запросов"""
+        trees = self.import_trees("imports")
+        for shape, items in trees.items():
+            files = [
+                dict(item, size=item["size"] + 1)
+                for item in items
+                if item["type"] == "FILE"
+            ]
+            data = dict(items=files, updateDate=self.dates[shape])
+            self.measure(
+                "imports_update", shape, len(files), "post", "/imports", data
+            )
+
+    def test_import_moves(self):
+        """Проверка числа запросов на импорт, переносящий пачку узлов"""
+        trees = self.import_trees()
+        for shape, items in trees.items():
+            moved = [
+                dict(item, parentId=items[0]["id"])
+                for item in self.deepest(items)
+            ]
+            data = dict(items=moved, updateDate=self.dates[shape])
+            self.measure(
+                "imports_moves", shape, len(moved), "post", "/imports", data
+            )
+
+    def test_nodes(self):
+        """Проверка, что поддерево и список всех деревьев читаются без
+        запросов на каждый узел"""
+
+        def read(shape: str, items: list):
+            path = f"/nodes/{items[0]['id']}"
+            self.measure("nodes", shape, len(items), "get", path)
+            count = FileSystem.objects.count()
+            self.measure("nodes_list", shape, count, "get", "/nodes")
+
+        self.import_trees(action=read)
+
+    def test_updates(self):
+        """Проверка, что страница /updates читается одним запросом"""
+        trees = self.import_trees()
+        for shape, items in trees.items():
+            files = [item for item in items if item["type"] == "FILE"]
+            query = dict(date=self.dates[shape])
+            self.measure(
+                "updates", shape, len(files), "get", "/updates", query
+            )
+
+    def test_history(self):
+        """Проверка, что история узла читается за постоянное число
+        запросов при любом числе записей"""
+        trees = self.import_trees()
+        items = trees["large"]
+        files = [item for item in items if item["type"] == "FILE"]
+        for size in range(2, 10):
+            files = [dict(item, size=size) for item in files]
+            data = dict(items=files, updateDate=self.dates["large"])
+            self.request("post", "/imports", data)
+        for shape, items in trees.items():
+            node_id = items[0]["id"]
+            count = History.objects.filter(node_id=node_id).count()
+            path = f"/node/{node_id}/history"
+            self.measure("history", shape, count, "get", path)
+
+    def test_stats(self):
+        """Проверка, что счетчики папки читаются одним запросом"""
+        trees = self.import_trees()
+        for shape, items in trees.items():
+            path = f"/node/{items[0]['id']}/stats"
+            self.measure("stats", shape, len(items), "get", path)
+
+    def test_delete(self):
+        """Проверка, что удаление пачки узлов и поддерева идут за постоянное
+        число запросов"""
+        trees = self.import_trees()
+        for shape, items in trees.items():
+            ids = [item["id"] for item in self.deepest(items)]
+            data = dict(ids=ids, date=self.dates[shape])
+            self.measure(
+                "delete_batch", shape, len(ids), "post", "/delete", data
+            )
+            root = FileSystem.objects.get(id=items[0]["id"])
+            count = root.get_descendants(include_self=True).count()
+            path = f"/delete/{root.id}?date={self.dates[shape]}"
+            self.measure("delete", shape, count, "delete", path)
+
+
+@override_settings(TREE_BACKEND=CLOSURE_TREE)
+class ClosureQueryCountTests(QueryCountTests):
+    backend = "closure"
+    # Перенос в таблице замыкания - отдельные запросы на каждый узел,
+    # поддерево читается структурой и затем страницами снимков.
+    limits = dict(QueryCountTests.limits, imports_moves=(10, 8), nodes=(2, 0))
@@ -1,25 +1,37 @@
-from django.urls import include, path
+from django.urls import include, path, re_path
 from rest_framework.routers import DefaultRouter
 
 from api.views import (
     DeleteViewSet,
-    HistoryViewSet,
     ImportsViewSet,
     NodesViewSet,
-    UpdatesViewSet,
+    metrics,
+    node_detail,
+    node_history,
+    node_stats,
+    updates,
 )
 
 app_name = "api"
 router = DefaultRouter(trailing_slash=False)
 router.register("imports", ImportsViewSet, basename="imports")
-router.register(
-    r"node/(?P<node_id>[\w.@+-]+)/history", HistoryViewSet, basename="history"
-)
 router.register("nodes", NodesViewSet, basename="nodes")
-router.register("updates", UpdatesViewSet, basename="updates")
 router.register("delete", DeleteViewSet, basename="delete")
 
 
 urlpatterns = [
+    path("nodes/<str:pk>", node_detail, name="nodes-detail"),
+    path("updates", updates, name="updates-list"),
+    path("metrics", metrics, name="metrics"),
+    re_path(
+        r"^node/(?P<node_id>[\w.@+-]+)/history$",
+        node_history,
+        name="history-list",
+    ),
+    re_path(
+        r"^node/(?P<node_id>[\w.@+-]+)/stats$",
+        node_stats,
+        name="stats-detail",
+    ),
     path("", include(router.urls)),
 ]
@@ -0,0 +1,95 @@
+import re
+
+from rest_framework.exceptions import ValidationError
+
+from core.models import TYPE_NAME
+
+URL_MAX_LENGTH = 255
+SIZE_MAX_STRING_LENGTH = 1000
+DECIMAL_TAIL = re.compile(r"\.0*\s*$")
+PROHIBITED_CHARS = re.compile(r"[\x00\ud800-\udfff]")
+
+
+class FieldError(Exception):
+    pass
+
+
+def _string(value) -> str:
+    """Правила serializers.CharField: числа приводятся к строке, пробелы
+    по краям отбрасываются, пустая строка и символы NUL и суррогаты - ошибка.
+    """
+    if isinstance(value, str):
+        value = value.strip()
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value).strip()
+    else:
+        raise FieldError("Ожидалась строка")
+    if not value:
+        raise FieldError("Пустое значение")
+    if PROHIBITED_CHARS.search(value):
+        raise FieldError("Недопустимые символы")
+    return value
+
+
+def _size(value) -> int:
+    """Правила serializers.IntegerField(min_value=1)."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        size = value
+    else:
+        if isinstance(value, str) and len(value) > SIZE_MAX_STRING_LENGTH:
+            raise FieldError("Слишком длинное значение")
+        try:
+            size = int(DECIMAL_TAIL.sub("", str(value)))
+        except (TypeError, ValueError):
+            raise FieldError("Ожидалось целое число")
+    if size < 1:
+        raise FieldError("Размер должен быть положительным")
+    return size
+
+
+def validate_import_item(item) -> dict:
+    """Проверяет элемент импорта по тем же правилам, что и
+    NodesItemsImportSerializer, но без построения полей сериализатора на
+    каждый элемент. Возвращает проверенный элемент, при ошибке -
+    ValidationError с теми же полями."""
+    if not isinstance(item, dict):
+        raise ValidationError({"non_field_errors": ["Ожидался объект"]})
+    attrs, errors = {}, {}
+    for key in ("id", "url", "parentId", "size", "type"):
+        if key not in item:
+            if key in ("url", "size"):
+                continue
+            errors[key] = ["Обязательное поле"]
+            continue
+        value = item[key]
+        try:
+            if value is None:
+                if key in ("id", "type"):
+                    raise FieldError("Не может быть null")
+            elif key == "size":
+                value = _size(value)
+            else:
+                value = _string(value)
+                if key == "url" and len(value) > URL_MAX_LENGTH:
+                    raise FieldError("Слишком длинное значение")
+                if key == "type" and value not in TYPE_NAME:
+                    raise FieldError("Некорректный тип")
+        except FieldError as error:
+            errors[key] = [str(error)]
+            continue
+        attrs[key] = value
+    if errors:
+        raise ValidationError(errors)
+
+    if attrs["type"] == "FILE":
+        if "url" not in attrs or "size" not in attrs:
+            raise ValidationError(
+                {"non_field_errors": ["Недостаточно данных"]}
+            )
+        if attrs["url"] is None:
+            raise ValidationError(
+                {"non_field_errors": ["У файла не может быть null"]}
+            )
+    elif attrs.get("url") is not None or attrs.get("size") is not None:
+        raise ValidationError({"non_field_errors": ["У папки всегда null"]})
+    return attrs
@@ -1,135 +1,220 @@
-from datetime import datetime, timedelta
+from collections import defaultdict
+from datetime import timedelta
+from functools import wraps
+from itertools import chain
 
-from django.db import IntegrityError
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
 from rest_framework import mixins, status
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import (
+    APIException,
+    MethodNotAllowed,
+    NotFound,
+    ValidationError,
+)
 from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
-from rest_framework.viewsets import GenericViewSet, ReadOnlyModelViewSet
+from rest_framework.viewsets import GenericViewSet
 
+from api.asgi import AsyncStreamingHttpResponse
+from api.cache import cache_stream, cached_subtree, invalidate_nodes
+from api.exception import ERROR_MESSAGES
+from api.imports import NodesImport
+from api.jobs import enqueue_import
+from api.metrics import CONTENT_TYPE, render_metrics
+from api.parsers import parse_import
 from api.serializers import (
     DateTimeSerializer,
+    ImportJobSerializer,
+    NodesDeleteSerializer,
     NodesImportsSerializer,
     NodesSerializer,
-    NodesUpdateSerializer,
+)
+from api.streaming import (
+    decode_cursor,
+    history_json,
+    subtree_json,
+    subtree_pages,
+    updates_json,
+    updates_rows,
 )
 from core.models import (
+    SNAPSHOT_FIELDS,
+    TYPE_DISPLAY,
     TYPE_FILE,
-    TYPE_NAME,
+    TYPE_FOLDER,
     FileSystem,
     History,
-    change_size_set_data,
-    recount_size_set_data,
-    set_position_history,
+    ImportJob,
+    SizePropagation,
+    format_date,
 )
+from core.tree import check_locked, delete_subtrees, run_locked
+
 
+JSON_PARAMS = dict(ensure_ascii=False, separators=(",", ":"))
 
-class NodesViewSet(ReadOnlyModelViewSet):
+
+class NodesViewSet(mixins.ListModelMixin, GenericViewSet):
     serializer_class = NodesSerializer
 
     def get_queryset(self):
-        if self.action == "list":
-            return FileSystem.objects.root_nodes()
-        return FileSystem.objects.all()
+        return FileSystem.objects.root_nodes()
+
+    def list(self, request, *args, **kwargs):
+        """Все деревья одним запросом values_list в формате NodesSerializer:
+        дети раскладываются по родителям в памяти, без запросов на папку.
+        Братья идут по lft, в таблице замыкания - по id."""
+        rows = FileSystem.objects.order_by("tree_id", "lft", "id")
+        children = defaultdict(list)
+        for node_id, url, node_type, parent_id, date, size in rows.values_list(
+            *SNAPSHOT_FIELDS
+        ):
+            children[parent_id].append(
+                dict(
+                    id=node_id,
+                    url=url,
+                    type=TYPE_DISPLAY[node_type],
+                    parentId=parent_id,
+                    date=date,
+                    size=size,
+                    children=(
+                        children[node_id] if node_type == TYPE_FOLDER else None
+                    ),
+                )
+            )
+        return Response(children[None])
+
+
+def read_view(view):
+    """Асинхронный GET-обработчик вне DRF. Ошибки APIException отдаются в
+    том же формате, что и custom_exception_handler. Как и представления
+    DRF, обработчик не проверяет CSRF: другие методы получают JSON 405, а
+    не HTML-страницу CSRF."""
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            if request.method not in ("GET", "HEAD"):
+                raise MethodNotAllowed(request.method)
+            return await view(request, *args, **kwargs)
+        except APIException as error:
+            message = ERROR_MESSAGES.get(error.status_code, error.detail)
+            return JsonResponse(
+                {"code": error.status_code, "message": message},
+                status=error.status_code,
+                json_dumps_params=JSON_PARAMS,
+            )
+
+    # csrf_exempt в Django 3.2 оборачивает обработчик синхронной функцией,
+    # и он перестал бы считаться асинхронным.
+    wrapper.csrf_exempt = True
+    return wrapper
+
 
+@read_view
+async def node_detail(request, pk):
+    key, body = await sync_to_async(cached_subtree)(pk)
+    if body is not None:
+        return HttpResponse(body, content_type="application/json")
+    pages = subtree_pages(pk)
+    page = await sync_to_async(next)(pages, None)
+    if page is None:
+        raise NotFound()
+    return AsyncStreamingHttpResponse(
+        cache_stream(subtree_json(chain([page], pages)), key),
+        content_type="application/json",
+    )
 
-class ImportsViewSet(mixins.CreateModelMixin, GenericViewSet):
+
+class ImportsViewSet(
+    mixins.CreateModelMixin, mixins.RetrieveModelMixin, GenericViewSet
+):
     serializer_class = NodesImportsSerializer
 
     def create(self, request, *args, **kwargs):
-        serializer = NodesImportsSerializer(
-            data=request.data, context={"request": request}
+        items_data, update_date = _import_data(request)
+        if not _is_id_unique([item["id"] for item in items_data]):
+            raise ValidationError({"detail": "Одинаковые id"})
+        if request.query_params.get("async") == "true":
+            job = enqueue_import(items_data, update_date)
+            return Response(
+                ImportJobSerializer(job).data,
+                status=status.HTTP_202_ACCEPTED,
+            )
+        NodesImport(items=items_data, update_date=update_date).run()
+        return Response(status=status.HTTP_200_OK)
+
+    def retrieve(self, request, *args, **kwargs):
+        job = get_object_or_404(ImportJob, id=kwargs["pk"])
+        return Response(ImportJobSerializer(job).data)
+
+
+def _import_data(request) -> tuple:
+    """Проверенные (items, updateDate). JSON читается потоком, не собирая
+    request.data и сериализатор на всю пачку."""
+    media_type = request.content_type.split(";")[0].strip().lower()
+    if media_type == "application/json":
+        return parse_import(
+            request.stream, request.encoding or settings.DEFAULT_CHARSET
         )
-        if serializer.is_valid(raise_exception=True):
-            items_data = serializer.validated_data.get("items")
-            if not _is_id_unique([item["id"] for item in items_data]):
-                raise ValidationError({"detail": "Одинаковые id"})
-            if not _is_parents_folders(
-                [
-                    item["parentId"]
-                    for item in items_data
-                    if item["parentId"] is not None
-                ]
-            ):
-                raise ValidationError(
-                    {"detail": "Родитель должен существовать и быть папкой"}
-                )
-            update_date = serializer.validated_data.get("updateDate")
-            for item in items_data:
-                if item.get("size", False) is None:
-                    item.pop("size")
-                item["date"] = update_date
-                item["type"] = TYPE_NAME[item["type"]]
-                parent = item.get("parentId", None)
-                if parent:
-                    item["parent"] = get_object_or_404(FileSystem, id=parent)
-                if "parentId" in item:
-                    item.pop("parentId")
-
-                if FileSystem.objects.filter(id=item["id"]).exists():
-                    node = _update_node(item)
-                else:
-                    try:
-                        node = FileSystem.objects.create(**item)
-                    except IntegrityError:
-                        raise ValidationError({"detail": "Ошибка создания"})
-                    recount_size_set_data(instance=node)
-
-                if node.type == TYPE_FILE:
-                    set_position_history(node=node)
-            return Response(status=status.HTTP_200_OK)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    serializer = NodesImportsSerializer(
+        data=request.data, context={"request": request}
+    )
+    serializer.is_valid(raise_exception=True)
+    return (
+        serializer.validated_data["items"],
+        serializer.validated_data["updateDate"],
+    )
 
 
 def _is_id_unique(values: list) -> bool:
     return len(values) == len(set(values))
 
 
-def _is_parents_folders(values: list) -> bool:
-    values = set(values)
-    for parent_id in values:
-        parent = get_object_or_404(FileSystem, id=parent_id)
-        if parent.is_file():
-            raise ValidationError({"detail": "Родитель только папка"})
-    return True
-
-
-def _update_node(data: dict) -> FileSystem:
-    node = FileSystem.objects.get(id=data["id"])
-    old_size = node.size
-    if data.get("size"):
-        node.size = data["size"]
-    node.date = data["date"]
-    if data.get("url"):
-        node.url = data["url"]
-    node.save()
-    if data.get("parent") and node.parent != data["parent"]:
-        node.move_to(target=data["parent"], old_size=old_size)
-    else:
-        change_size_set_data(instance=node, old_size=old_size)
-    return node
-
-
-class UpdatesViewSet(mixins.ListModelMixin, GenericViewSet):
-    def list(self, request, *args, **kwargs):
-        date = request.query_params.get("date")
-        if not date:
-            raise ValidationError({"detail": "Отсутствует date"})
+@read_view
+async def updates(request):
+    date = request.GET.get("date")
+    if not date:
+        raise ValidationError({"detail": "Отсутствует date"})
 
-        request.data["date"] = date
-        serializer = DateTimeSerializer(data=request.data)
+    serializer = DateTimeSerializer(data={"date": date})
 
-        if not serializer.is_valid(raise_exception=True):
-            raise ValidationError({"detail": "Некорректная date"})
+    if not serializer.is_valid(raise_exception=True):
+        raise ValidationError({"detail": "Некорректная date"})
 
-        end_date = datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
-        one_day_delta = timedelta(hours=24)
-        start_date = end_date - one_day_delta
-        nodes = FileSystem.objects.filter(
-            type=TYPE_FILE, date__range=(start_date, end_date)
+    end_date = serializer.validated_data["date"]
+    one_day_delta = timedelta(hours=24)
+    start_date = end_date - one_day_delta
+    nodes = FileSystem.objects.filter(
+        type=TYPE_FILE, date__range=(start_date, end_date)
+    )
+    cursor = request.GET.get("cursor")
+    if cursor:
+        try:
+            cursor_date, cursor_id = decode_cursor(cursor)
+        except ValueError:
+            raise ValidationError({"detail": "Некорректный cursor"})
+        nodes = nodes.filter(
+            Q(date__gt=cursor_date) | Q(date=cursor_date, id__gt=cursor_id)
         )
-        serializer = NodesUpdateSerializer({"items": nodes})
-        return Response(serializer.data)
+    nodes = nodes.order_by("date", "id")
+    limit = _updates_limit(request)
+    rows = await sync_to_async(updates_rows)(nodes, limit)
+    return AsyncStreamingHttpResponse(
+        updates_json(rows, limit), content_type="application/json"
+    )
+
+
+def _updates_limit(request) -> int:
+    limit = request.GET.get("limit")
+    if limit is None:
+        return settings.UPDATES_PAGE_SIZE
+    if not (limit.isascii() and limit.isdigit()) or int(limit) < 1:
+        raise ValidationError({"detail": "Некорректный limit"})
+    return min(int(limit), settings.UPDATES_PAGE_SIZE)
 
 
 class DeleteViewSet(mixins.DestroyModelMixin, GenericViewSet):
@@ -140,42 +225,96 @@ class DeleteViewSet(mixins.DestroyModelMixin, GenericViewSet):
             request.data["date"] = new_date
             serializer = DateTimeSerializer(data=request.data)
             if serializer.is_valid(raise_exception=True):
-                node.date = new_date
-                node.save()
-                recount_size_set_data(instance=node, add_operation=False)
-                node.delete()
+                _delete_nodes({node.id}, serializer.validated_data["date"])
             return Response(status=status.HTTP_200_OK)
         raise ValidationError({"detail": "Некорректное значение"})
 
+    def create(self, request, *args, **kwargs):
+        """POST /delete: удаление пачки узлов ids. Отдельный путь вроде
+        /delete/batch совпал бы с /delete/{id} узла с таким id."""
+        serializer = NodesDeleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        _delete_nodes(
+            set(serializer.validated_data["ids"]),
+            serializer.validated_data["date"],
+        )
+        return Response(status=status.HTTP_200_OK)
+
+
+def _delete_nodes(ids: set, date):
+    """Удаляет узлы ids под блокировками их деревьев. Узлы перечитываются
+    уже под блокировкой: параллельный импорт мог их перенумеровать."""
+
+    def delete(tree_ids: set):
+        nodes = list(FileSystem.objects.filter(id__in=ids))
+        if len(nodes) != len(ids):
+            raise NotFound()
+        check_locked(tree_ids, nodes)
+        propagation = SizePropagation(date=date)
+        deleted = delete_subtrees(nodes, propagation)
+        invalidate_nodes(ids.union(deleted, propagation.deltas))
+        propagation.save()
+
+    tree_ids = FileSystem.objects.filter(id__in=ids).values_list(
+        "tree_id", flat=True
+    )
+    run_locked(set(tree_ids), delete)
+
+
+@read_view
+async def node_history(request, node_id):
+    date_start = request.GET.get("dateStart")
+    date_end = request.GET.get("dateEnd")
+    if (date_start and not date_end) or (date_end and not date_start):
+        raise ValidationError({"detail": "Некорректные интервалы"})
+
+    node = FileSystem.objects.filter(id=node_id)
+    if not await sync_to_async(node.exists)():
+        raise NotFound()
+    query_without_dates = date_start is None and date_end is None
+    positions = History.objects.filter(node_id=node_id)
+    if not query_without_dates:
+        data = [{"date": date_start}, {"date": date_end}]
+        serializer = DateTimeSerializer(data=data, many=True)
+        if not serializer.is_valid(raise_exception=True):
+            raise ValidationError({"detail": "Невалидные интервалы"})
+
+        date_start, date_end = (
+            item["date"] for item in serializer.validated_data
+        )
+        positions = positions.filter(
+            change_date__gte=date_start, change_date__lt=date_end
+        )
+    return AsyncStreamingHttpResponse(
+        history_json(positions), content_type="application/json"
+    )
+
+
+@read_view
+async def node_stats(request, node_id):
+    """Размер, дата и число файлов и папок в поддереве узла из одной
+    строки, без обхода поддерева."""
+    node = await sync_to_async(
+        FileSystem.objects.filter(id=node_id)
+        .values("type", "date", "size", "file_count", "folder_count")
+        .first
+    )()
+    if node is None:
+        raise NotFound()
+    return JsonResponse(
+        dict(
+            id=node_id,
+            type=TYPE_DISPLAY[node["type"]],
+            date=format_date(node["date"]),
+            size=node["size"],
+            fileCount=node["file_count"],
+            folderCount=node["folder_count"],
+        ),
+        json_dumps_params=JSON_PARAMS,
+    )
 
-class HistoryViewSet(mixins.ListModelMixin, GenericViewSet):
-    def list(self, request, *args, **kwargs):
-        date_start = request.query_params.get("dateStart")
-        date_end = request.query_params.get("dateEnd")
-        if (date_start and not date_end) or (date_end and not date_start):
-            raise ValidationError({"detail": "Некорректные интервалы"})
-
-        node = get_object_or_404(FileSystem, id=kwargs["node_id"])
-        query_without_dates = date_start is None and date_end is None
-        if query_without_dates:
-            positions = History.objects.filter(node=node).values_list(
-                "position", flat=True
-            )
-        else:
-            data = [{"date": date_start}, {"date": date_end}]
-            serializer = DateTimeSerializer(data=data, many=True)
-            if not serializer.is_valid(raise_exception=True):
-                raise ValidationError({"detail": "Невалидные интервалы"})
-
-            date_start = datetime.strptime(date_start, "%Y-%m-%dT%H:%M:%SZ")
-            one_sec_delta = timedelta(seconds=1)
-            date_end = (
-                datetime.strptime(date_end, "%Y-%m-%dT%H:%M:%SZ")
-                - one_sec_delta
-            )
 
-            positions = History.objects.filter(
-                node=node, change_date__range=(date_start, date_end)
-            ).values_list("position", flat=True)
-        data = {"items": [eval(position) for position in positions]}
-        return Response(data)
+def metrics(request):
+    """Гистограммы MetricsMiddleware в текстовом формате Prometheus.
+    Снаружи закрыто в nginx."""
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
@@ -33,6 +33,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -83,6 +84,26 @@ else:
         }
     }
 
+CACHE_BACKENDS = {
+    "locmem": ("django.core.cache.backends.locmem.LocMemCache", "enrollment"),
+    "db": ("django.core.cache.backends.db.DatabaseCache", "cache_table"),
+    "file": (
+        "django.core.cache.backends.filebased.FileBasedCache",
+        BASE_DIR / "cache",
+    ),
+}
+cache_backend, cache_location = CACHE_BACKENDS[
+    os.getenv("CACHE_BACKEND") or ("locmem" if DEBUG else "db")
+]
+CACHES = {
+    "default": {
+        "BACKEND": cache_backend,
+        "LOCATION": os.getenv("CACHE_LOCATION") or cache_location,
+        "TIMEOUT": int(os.getenv("CACHE_TIMEOUT") or 3600),
+    }
+}
+NODES_CACHE = "default"
+NODES_CACHE_MAX_SIZE = int(os.getenv("NODES_CACHE_MAX_SIZE") or 1024 * 1024)
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -129,7 +150,37 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 REST_FRAMEWORK = {
     "EXCEPTION_HANDLER": "api.exception.custom_exception_handler",
     "TEST_REQUEST_DEFAULT_FORMAT": "json",
-    "DATETIME_FORMAT": "%Y-%m-%dT%H:%M:%S.%fZ",
+    "DEFAULT_RENDERER_CLASSES": (
+        "api.renderers.ORJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ),
+    "DEFAULT_PARSER_CLASSES": (
+        "api.renderers.ORJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ),
+    # Даты отдаются объектами datetime, их кодирует ORJSONRenderer.
+    "DATETIME_FORMAT": None,
 }
 
 APPEND_SLASH = False
+
+NODES_SNAPSHOTS = True if os.getenv("NODES_SNAPSHOTS") == "True" else False
+
+UPDATES_PAGE_SIZE = int(os.getenv("UPDATES_PAGE_SIZE") or 10000)
+
+IMPORT_REBUILD_MOVES = int(os.getenv("IMPORT_REBUILD_MOVES") or 5)
+
+# После смены движка: python manage.py rebuild_tree
+TREE_BACKENDS = {
+    "nested_set": "core.tree.NestedSetTree",
+    "closure": "core.closure.ClosureTree",
+}
+TREE_BACKEND = TREE_BACKENDS[os.getenv("TREE_BACKEND") or "nested_set"]
+
+# Запросы дольше порога пишутся в лог api.metrics с разбивкой по SQL.
+# 0 - не писать.
+METRICS_SLOW_REQUEST_MS = float(os.getenv("METRICS_SLOW_REQUEST_MS") or 0)
+
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS") or 2)
+IMPORT_WORKER_POLL = float(os.getenv("IMPORT_WORKER_POLL") or 1)
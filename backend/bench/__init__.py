@@ -0,0 +1,47 @@
+"""Бенчмарки. Запуск из каталога backend: python -m bench.<имя> --help"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+django.setup()
+
+DATE = "2022-09-01T00:00:00Z"
+
+
+def timed(action, repeat: int = 3) -> float:
+    """Лучшее время action() в секундах из repeat запусков."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def commit() -> str:
+    """Короткий хеш текущего коммита, чтобы сравнивать результаты."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(name: str, results: dict, output: str = None):
+    """Печатает результаты в JSON, с output - еще и пишет их в файл."""
+    results = dict(benchmark=name, commit=commit(), **results)
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
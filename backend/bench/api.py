@@ -0,0 +1,252 @@
+"""Нагрузка на API. Синтетические деревья импортируются через /imports
+пачками по уровням, затем замеряются /nodes/{id}, /updates,
+/node/{id}/history и /delete/{id}. Для каждого эндпоинта - число запросов,
+ошибки, запросов в секунду, p50 и p99 в секундах.
+
+Без --url запросы идут через тестовый клиент Django на отдельной тестовой
+базе. С --url - в уже запущенный сервер в --workers потоков, узлы
+создаются с уникальным префиксом и удаляются после замера.
+
+Результаты сравниваются между коммитами через --output и --baseline."""
+import argparse
+import json
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from django.db import connection
+from django.test import Client
+
+from api.testing import synthetic_items
+from bench import report
+
+START_DATE = datetime(2022, 9, 1, tzinfo=timezone.utc)
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class ClientTransport:
+    """Запросы через тестовый клиент Django, в одном потоке."""
+
+    def __init__(self):
+        self.client = Client()
+
+    def request(self, method: str, path: str, body: dict = None) -> int:
+        if method == "POST":
+            response = self.client.post(
+                path, json.dumps(body), content_type="application/json"
+            )
+        elif method == "DELETE":
+            response = self.client.delete(path)
+        else:
+            response = self.client.get(path)
+        if response.streaming:
+            b"".join(response.streaming_content)
+        return response.status_code
+
+
+class HTTPTransport:
+    """Запросы в запущенный сервер, как в unit_test.py."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+
+    def request(self, method: str, path: str, body: dict = None) -> int:
+        headers, data = {}, None
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+            data = json.dumps(body).encode()
+        request = Request(
+            self.url + path, method=method, data=data, headers=headers
+        )
+        try:
+            with urlopen(request) as response:
+                response.read()
+                return response.status
+        except HTTPError as error:
+            error.read()
+            return error.code
+
+
+def percentile(values: list, percent: float) -> float:
+    """Процентиль по ближайшему рангу, values отсортированы."""
+    if not values:
+        return None
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+def measure(transport, phases: list, workers: int) -> dict:
+    """Выполняет запросы (method, path, body) по фазам: следующая фаза
+    начинается, когда закончилась предыдущая, внутри фазы запросы идут в
+    workers потоков."""
+
+    def call(request) -> tuple:
+        start = time.perf_counter()
+        status = transport.request(*request)
+        return time.perf_counter() - start, status
+
+    results = []
+    start = time.perf_counter()
+    if workers == 1:
+        for requests in phases:
+            results.extend(map(call, requests))
+    else:
+        with ThreadPoolExecutor(workers) as pool:
+            for requests in phases:
+                results.extend(pool.map(call, requests))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for latency, _ in results)
+    return dict(
+        requests=len(results),
+        errors=sum(status >= 400 for _, status in results),
+        throughput=len(results) / elapsed if elapsed else None,
+        p50=percentile(latencies, 50),
+        p99=percentile(latencies, 99),
+    )
+
+
+def import_phases(trees: list, batch: int) -> list:
+    """Пачки /imports по уровням деревьев: пачки одного уровня не зависят
+    друг от друга и могут идти параллельно."""
+    levels = []
+    for items in trees:
+        depth = {None: -1}
+        for item in items:
+            level = depth[item["parentId"]] + 1
+            depth[item["id"]] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(item)
+    phases, second = [], 0
+    for items in levels:
+        requests = []
+        for start in range(0, len(items), batch):
+            second += 1
+            date = START_DATE + timedelta(seconds=second)
+            body = dict(
+                items=items[start:start + batch],
+                updateDate=date.strftime(DATE_FORMAT),
+            )
+            requests.append(("POST", "/imports", body))
+        phases.append(requests)
+    return phases
+
+
+def run(transport, args) -> dict:
+    rng = random.Random(args.seed)
+    trees = [
+        synthetic_items(f"{args.prefix}{number}-", args.depth, args.fanout)
+        for number in range(args.trees)
+    ]
+    folders, files = [], []
+    for items in trees:
+        for item in items:
+            ids = folders if item["type"] == "FOLDER" else files
+            ids.append(item["id"])
+    requests = args.requests
+    date = (START_DATE + timedelta(hours=12)).strftime(DATE_FORMAT)
+    delete_date = (START_DATE + timedelta(days=1)).strftime(DATE_FORMAT)
+    workload = dict(
+        imports=import_phases(trees, args.batch),
+        nodes=[
+            [
+                ("GET", f"/nodes/{rng.choice(folders)}")
+                for _ in range(requests)
+            ]
+        ],
+        updates=[[("GET", f"/updates?date={date}")] * requests],
+        history=[
+            [
+                ("GET", f"/node/{node_id}/history")
+                for node_id in rng.choices(folders + files, k=requests)
+            ]
+        ],
+        delete=[
+            [
+                ("DELETE", f"/delete/{node_id}?date={delete_date}")
+                for node_id in rng.sample(files, min(requests, len(files)))
+            ]
+        ],
+    )
+    endpoints = {
+        name: measure(transport, phases, args.workers)
+        for name, phases in workload.items()
+    }
+    return dict(
+        nodes=sum(len(items) for items in trees),
+        endpoints=endpoints,
+        cleanup=[
+            ("DELETE", f"/delete/{items[0]['id']}?date={delete_date}")
+            for items in trees
+        ],
+    )
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    """Отношения новых значений к базовым: больше 1 по p50 и p99 -
+    медленнее, меньше 1 по throughput - медленнее."""
+    ratios = {}
+    for name, stats in results.items():
+        old = baseline["endpoints"].get(name)
+        if not old:
+            continue
+        ratios[name] = {
+            key: round(stats[key] / old[key], 3)
+            for key in ("throughput", "p50", "p99")
+            if stats[key] and old[key]
+        }
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--url", help="например http://localhost:8000")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--trees", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="куда еще записать JSON")
+    parser.add_argument("--baseline", help="JSON прошлого запуска")
+    args = parser.parse_args()
+
+    if args.url:
+        args.prefix = f"bench-{int(time.time())}-"
+        transport = HTTPTransport(args.url)
+        results = run(transport, args)
+        measure(transport, [results.pop("cleanup")], args.workers)
+    else:
+        args.prefix, args.workers = "bench-", 1
+        database = connection.creation.create_test_db(verbosity=0)
+        try:
+            results = run(ClientTransport(), args)
+            results.pop("cleanup")
+        finally:
+            connection.creation.destroy_test_db(database, verbosity=0)
+
+    results = dict(
+        mode=args.url or "client",
+        workers=args.workers,
+        trees=args.trees,
+        depth=args.depth,
+        fanout=args.fanout,
+        **results,
+    )
+    if args.baseline:
+        with open(args.baseline) as file:
+            results["baseline"] = compare(
+                results["endpoints"], json.load(file)
+            )
+    report("api", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Сериализация ответа /nodes на 100k узлов: строки дат DATETIME_FORMAT и
+JSONRenderer против datetime и ORJSONRenderer. Потоковые /nodes/{id} без
+готовых снимков и /node/{id}/history: стандартный json против orjson."""
+import argparse
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from unittest import mock
+
+from rest_framework.fields import DateTimeField
+from rest_framework.renderers import JSONRenderer
+
+from api.renderers import ORJSONRenderer
+from api.streaming import _history_item, subtree_json
+from bench import report, timed
+from core.models import TYPE_DISPLAY, TYPE_NAME, format_date
+
+OLD_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def build_tree(nodes: int, fanout: int, date_field: DateTimeField) -> list:
+    """Дерево в том виде, в каком его отдает NodesSerializer: папки с
+    fanout детьми, половина детей - файлы."""
+    start = datetime(2022, 9, 1, tzinfo=timezone.utc)
+    root = _node(0, None, "FOLDER", start, date_field)
+    folders, count = [root], 1
+    while count < nodes:
+        parent = folders.pop(0)
+        for number in range(min(fanout, nodes - count)):
+            node_type = "FOLDER" if number % 2 else "FILE"
+            date = start + timedelta(seconds=count)
+            node = _node(count, parent["id"], node_type, date, date_field)
+            parent["children"].append(node)
+            if node_type == "FOLDER":
+                folders.append(node)
+            count += 1
+    return [root]
+
+
+def _node(number, parent_id, node_type, date, date_field) -> OrderedDict:
+    return OrderedDict(
+        id=f"node{number}",
+        url=None if node_type == "FOLDER" else f"/file/{number}",
+        type=node_type,
+        parentId=parent_id,
+        date=date_field.to_representation(date),
+        size=number,
+        children=[] if node_type == "FOLDER" else None,
+    )
+
+
+def subtree_rows(tree: list) -> list:
+    """Строки subtree_pages без готовых снимков для дерева build_tree."""
+    counter = count(1)
+
+    def walk(node: dict):
+        row = [None, next(counter), 0, node["id"], node["url"]]
+        row.extend((TYPE_NAME[node["type"]], node["parentId"]))
+        row.extend((node["date"], node["size"]))
+        yield row
+        for child in node["children"] or ():
+            yield from walk(child)
+        row[2] = next(counter)
+
+    return list(walk(tree[0]))
+
+
+def json_snapshot(node_id, url, node_type, parent_id, date, size) -> str:
+    """render_snapshot на стандартном json."""
+    return json.dumps(
+        dict(
+            id=node_id,
+            url=url,
+            type=TYPE_DISPLAY[node_type],
+            parentId=parent_id,
+            date=format_date(date),
+            size=size,
+        ),
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+def json_history_item(
+    change_date, history_id, node_id, url, parent_id, size, node_type
+) -> str:
+    """_history_item на стандартном json."""
+    return json.dumps(
+        dict(
+            id=node_id,
+            url=url,
+            date=format_date(change_date),
+            parentId=parent_id,
+            size=size,
+            type=TYPE_DISPLAY[node_type],
+        ),
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--nodes", type=int, default=100000)
+    parser.add_argument("--fanout", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    def before():
+        date_field = DateTimeField(format=OLD_DATETIME_FORMAT)
+        tree = build_tree(args.nodes, args.fanout, date_field)
+        return JSONRenderer().render(tree)
+
+    def after():
+        tree = build_tree(args.nodes, args.fanout, DateTimeField(format=None))
+        return ORJSONRenderer().render(tree)
+
+    old_tree = build_tree(
+        args.nodes, args.fanout, DateTimeField(format=OLD_DATETIME_FORMAT)
+    )
+    tree = build_tree(args.nodes, args.fanout, DateTimeField(format=None))
+    rows = subtree_rows(tree)
+    history = [
+        (date, number, node_id, url, parent_id, size, node_type)
+        for number, (_, _, _, node_id, url, node_type, parent_id, date, size)
+        in enumerate(rows)
+    ]
+
+    def subtree_before():
+        with mock.patch("api.streaming.render_snapshot", json_snapshot):
+            return b"".join(subtree_json([rows]))
+
+    seconds = dict(
+        json_subtree=timed(subtree_before, args.repeat),
+        orjson_subtree=timed(
+            lambda: b"".join(subtree_json([rows])), args.repeat
+        ),
+        json_history=timed(
+            lambda: [json_history_item(*row) for row in history], args.repeat
+        ),
+        orjson_history=timed(
+            lambda: [_history_item(*row) for row in history], args.repeat
+        ),
+        json_renderer=timed(before, args.repeat),
+        orjson_renderer=timed(after, args.repeat),
+        json_render_only=timed(
+            lambda: JSONRenderer().render(old_tree), args.repeat
+        ),
+        orjson_render_only=timed(
+            lambda: ORJSONRenderer().render(tree), args.repeat
+        ),
+    )
+    report(
+        "renderers",
+        dict(
+            nodes=args.nodes,
+            seconds=seconds,
+            speedup=round(
+                seconds["json_renderer"] / seconds["orjson_renderer"], 1
+            ),
+            size=len(ORJSONRenderer().render(tree)),
+        ),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Движки дерева NestedSetTree и ClosureTree на одних и тех же операциях:
+вставка пачки листьев, перенос поддерева, перенос пачки листьев внутри
+одной папки верхнего уровня, чтение поддерева. Запускается на
+отдельной тестовой базе, рабочая база не затрагивается."""
+import argparse
+from datetime import datetime, timezone
+
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import override_settings
+
+from api.imports import NodesImport
+from api.streaming import subtree_pages
+from api.testing import synthetic_items
+from bench import report, timed
+
+BACKENDS = {
+    "nested_set": "core.tree.NestedSetTree",
+    "closure": "core.closure.ClosureTree",
+}
+
+
+class Clock:
+    def __init__(self):
+        self.second = 0
+
+    def __call__(self) -> datetime:
+        self.second += 1
+        return datetime.fromtimestamp(1661990400 + self.second, timezone.utc)
+
+
+def measure(args) -> dict:
+    clock = Clock()
+    NodesImport(synthetic_items("a", args.depth, args.fanout), clock()).run()
+    NodesImport(synthetic_items("b", args.depth, args.fanout), clock()).run()
+    number = 0
+
+    def insert():
+        nonlocal number
+        items = []
+        for _ in range(args.batch):
+            number += 1
+            items.append(
+                dict(
+                    id=f"leaf{number}",
+                    parentId="a1",
+                    url=f"/leaf/{number}",
+                    size=1,
+                    type="FILE",
+                )
+            )
+        NodesImport(items, clock()).run()
+
+    parents = ["b1", "a1"]
+
+    def move():
+        parents.reverse()
+        item = dict(id="a2", parentId=parents[0], type="FOLDER")
+        NodesImport([item], clock()).run()
+
+    folders = ["a1", "a10"]
+
+    def move_batch():
+        folders.reverse()
+        items = [
+            dict(id=f"leaf{leaf}", parentId=folders[0], type="FILE")
+            for leaf in range(1, args.moves + 1)
+        ]
+        NodesImport(items, clock()).run()
+
+    return dict(
+        insert=timed(insert, args.repeat),
+        move=timed(move, args.repeat),
+        move_batch=timed(move_batch, args.repeat),
+        subtree=timed(lambda: list(subtree_pages("a0")), args.repeat),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--moves", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    seconds = {}
+    database = connection.creation.create_test_db(verbosity=0)
+    try:
+        for name, backend in BACKENDS.items():
+            call_command("flush", interactive=False, verbosity=0)
+            with override_settings(TREE_BACKEND=backend):
+                seconds[name] = measure(args)
+    finally:
+        connection.creation.destroy_test_db(database, verbosity=0)
+    report(
+        "trees",
+        dict(
+            nodes=len(synthetic_items("a", args.depth, args.fanout)) * 2,
+            seconds=seconds,
+        ),
+    )
+
+
+if __name__ == "__main__":
+    main()
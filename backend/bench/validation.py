@@ -0,0 +1,63 @@
+"""Проверка элементов импорта: NodesImportsSerializer против
+validate_import_item и разбор тела запроса целиком против parse_import."""
+import argparse
+import io
+import json
+
+from api.parsers import parse_import
+from api.serializers import NodesImportsSerializer
+from api.validators import validate_import_item
+from bench import DATE, report, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    items = [
+        dict(
+            id=f"bench{number}",
+            url=f"/file/{number}",
+            parentId=f"bench{number // 10}",
+            size=number + 1,
+            type="FILE",
+        )
+        for number in range(args.items)
+    ]
+    payload = dict(items=items, updateDate=DATE)
+    body = json.dumps(payload).encode()
+
+    def serializer():
+        assert NodesImportsSerializer(data=payload).is_valid()
+
+    def validator():
+        for item in items:
+            validate_import_item(item)
+
+    def serializer_body():
+        data = json.loads(body)
+        assert NodesImportsSerializer(data=data).is_valid()
+
+    def streaming_body():
+        parse_import(io.BytesIO(body), "utf-8")
+
+    seconds = dict(
+        serializer=timed(serializer, args.repeat),
+        validator=timed(validator, args.repeat),
+        serializer_body=timed(serializer_body, args.repeat),
+        streaming_body=timed(streaming_body, args.repeat),
+    )
+    report(
+        "validation",
+        dict(
+            items=args.items,
+            seconds=seconds,
+            speedup=round(seconds["serializer"] / seconds["validator"], 1),
+        ),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.contrib.auth.models import Group, User
 from mptt.admin import DraggableMPTTAdmin
 
-from core.models import FileSystem, History
+from core.models import FileSystem, History, ImportJob
 
 
 @admin.register(FileSystem)
@@ -34,5 +34,17 @@ class FileSystemAdmin(admin.ModelAdmin):
         return False
 
 
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "status", "update_date", "created", "finished")
+    list_filter = ("status",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 admin.site.unregister(User)
 admin.site.unregister(Group)
@@ -0,0 +1,193 @@
+from collections import defaultdict
+from operator import attrgetter
+
+from django.db.models import F
+from mptt.exceptions import InvalidMove
+
+from core.models import SNAPSHOT_FIELDS, FileSystem, TreeClosure
+from core.tree import (
+    INSERT_BATCH_SIZE,
+    REBUILD_BATCH_SIZE,
+    TREE_FIELDS,
+    TreeNode,
+    build_nested_set,
+    delete_rows,
+    in_batches,
+)
+
+
+class ClosureTree:
+    """Таблица замыкания TreeClosure: на каждый узел по строке на каждого
+    предка. Вставка пишет только строки нового узла, перенос и удаление
+    затрагивают только переносимое или удаляемое поддерево. lft и rght в
+    этом режиме не ведутся, tree_id и level ведутся."""
+
+    def get_ancestors(self, node, ascending: bool, include_self: bool):
+        order = "descendant_links__depth"
+        return FileSystem.objects.filter(
+            descendant_links__descendant_id=node.id,
+            descendant_links__depth__gte=0 if include_self else 1,
+        ).order_by(order if ascending else f"-{order}")
+
+    def get_descendants(self, node, include_self: bool):
+        return FileSystem.objects.filter(
+            ancestor_links__ancestor_id=node.id,
+            ancestor_links__depth__gte=0 if include_self else 1,
+        ).order_by("ancestor_links__depth", "id")
+
+    def ancestors(self, nodes: list) -> list:
+        """Все предки узлов nodes без повторов."""
+        ancestors = {}
+        for batch in in_batches([node.id for node in nodes]):
+            links = TreeClosure.objects.filter(
+                descendant_id__in=batch, depth__gt=0
+            )
+            ancestors.update(
+                (node.id, node)
+                for node in FileSystem.objects.filter(
+                    id__in=links.values("ancestor_id")
+                )
+            )
+        return list(ancestors.values())
+
+    def subtree_pages(self, node_id: str, size: int):
+        """Страницы строк поддерева в том же виде, что у NestedSetTree.
+        Сначала читается только структура поддерева, lft и rght для
+        вложенности считаются по ней в памяти, братья идут по id. Снимки
+        узлов затем читаются страницами по size в порядке lft, так что в
+        памяти все поддерево держится только в виде TreeNode."""
+        rows = (
+            FileSystem.objects.filter(ancestor_links__ancestor_id=node_id)
+            .order_by("id")
+            .values_list("id", "parent_id")
+        )
+        nodes, children = {}, defaultdict(list)
+        for descendant_id, parent_id in rows.iterator(REBUILD_BATCH_SIZE):
+            node = TreeNode(descendant_id, parent_id, 0, 0, 0, 0)
+            nodes[descendant_id] = node
+            children[parent_id].append(node)
+        if node_id not in nodes:
+            return
+        build_nested_set(nodes[node_id], children, 0, 1, 0)
+        order = sorted(nodes.values(), key=attrgetter("lft"))
+        for start in range(0, len(order), size):
+            page = order[start:start + size]
+            snapshots = {}
+            for batch in in_batches([node.id for node in page]):
+                snapshots.update(
+                    (row[1], row)
+                    for row in FileSystem.objects.filter(
+                        id__in=batch
+                    ).values_list("snapshot", *SNAPSHOT_FIELDS)
+                )
+            rows = []
+            for node in page:
+                row = snapshots.get(node.id)
+                if row is not None:
+                    rows.append((row[0], node.lft, node.rght, *row[1:]))
+            yield rows
+
+    def insert(self, created: list, nodes: dict, existing: list):
+        """Записывает новые узлы и их связи со всеми предками. Цепочки
+        предков берутся из nodes, без запросов."""
+        links = []
+        for node in created:
+            node.lft = node.rght = node.level = 0
+            if node.parent_id is not None:
+                parent = nodes[node.parent_id]
+                node.tree_id, node.level = parent.tree_id, parent.level + 1
+            ancestor_id, depth = node.id, 0
+            while ancestor_id is not None:
+                links.append(
+                    TreeClosure(
+                        ancestor_id=ancestor_id,
+                        descendant_id=node.id,
+                        depth=depth,
+                    )
+                )
+                ancestor_id = nodes[ancestor_id].parent_id
+                depth += 1
+        FileSystem.objects.bulk_create(created, batch_size=INSERT_BATCH_SIZE)
+        TreeClosure.objects.bulk_create(links, batch_size=INSERT_BATCH_SIZE)
+
+    def move(self, moves: list):
+        for node, target in moves:
+            self.move_node(node, target)
+
+    def move_node(self, node, target, position: str = None):
+        """Переносит поддерево node под target: связи поддерева с прежними
+        предками удаляются, с новыми - создаются, у узлов поддерева
+        меняются tree_id и level. Порядок братьев не хранится, position
+        не используется."""
+        subtree = TreeClosure.objects.filter(ancestor_id=node.id)
+        descendants = list(subtree.values_list("descendant_id", "depth"))
+        if target.id in {descendant for descendant, _ in descendants}:
+            raise InvalidMove("A node may not be made a child of itself.")
+        ancestors = list(
+            TreeClosure.objects.filter(descendant_id=target.id).values_list(
+                "ancestor_id", "depth"
+            )
+        )
+        node.refresh_from_db(fields=TREE_FIELDS)
+        target.refresh_from_db(fields=TREE_FIELDS)
+
+        ids = subtree.values("descendant_id")
+        TreeClosure.objects.filter(descendant_id__in=ids).exclude(
+            ancestor_id__in=ids
+        ).delete()
+        TreeClosure.objects.bulk_create(
+            (
+                TreeClosure(
+                    ancestor_id=ancestor_id,
+                    descendant_id=descendant_id,
+                    depth=ancestor_depth + depth + 1,
+                )
+                for ancestor_id, ancestor_depth in ancestors
+                for descendant_id, depth in descendants
+            ),
+            batch_size=INSERT_BATCH_SIZE,
+        )
+        FileSystem.objects.filter(id__in=ids).update(
+            tree_id=target.tree_id,
+            level=F("level") + target.level + 1 - node.level,
+        )
+        FileSystem.objects.filter(id=node.id).update(parent_id=target.id)
+        node.parent_id, node.tree_id = target.id, target.tree_id
+        node.level = target.level + 1
+
+    def delete(self, roots: list) -> list:
+        deleted = []
+        for batch in in_batches([node.id for node in roots]):
+            ids = TreeClosure.objects.filter(ancestor_id__in=batch).values(
+                "descendant_id"
+            )
+            deleted.extend(delete_rows(FileSystem.objects.filter(id__in=ids)))
+            TreeClosure.objects.filter(descendant_id__in=ids).delete()
+        return deleted
+
+    def rebuild(self) -> int:
+        """Заполняет таблицу замыкания заново по parent_id."""
+        TreeClosure.objects.all().delete()
+        parents = dict(
+            FileSystem.objects.values_list("id", "parent_id").iterator(
+                chunk_size=REBUILD_BATCH_SIZE
+            )
+        )
+        links = []
+        for node_id in parents:
+            ancestor_id, depth = node_id, 0
+            while ancestor_id is not None:
+                links.append(
+                    TreeClosure(
+                        ancestor_id=ancestor_id,
+                        descendant_id=node_id,
+                        depth=depth,
+                    )
+                )
+                ancestor_id = parents[ancestor_id]
+                depth += 1
+            if len(links) >= REBUILD_BATCH_SIZE:
+                TreeClosure.objects.bulk_create(links)
+                links = []
+        TreeClosure.objects.bulk_create(links)
+        return len(parents)
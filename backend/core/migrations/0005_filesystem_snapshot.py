@@ -0,0 +1,18 @@
+# Generated by Django 3.2.15 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0004_history"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="filesystem",
+            name="snapshot",
+            field=models.TextField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,71 @@
+import ast
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+TYPE_NAME = {"FOLDER": 1, "FILE": 2}
+
+
+def positions_to_columns(apps, schema_editor):
+    History = apps.get_model("core", "History")
+    batch = []
+    for history in History.objects.order_by("pk").iterator(
+        chunk_size=BATCH_SIZE
+    ):
+        position = ast.literal_eval(history.position)
+        history.url = position["url"]
+        history.parent_id = position["parentId"]
+        history.type = TYPE_NAME[position["type"]]
+        history.size = position["size"]
+        batch.append(history)
+        if len(batch) == BATCH_SIZE:
+            History.objects.bulk_update(
+                batch, ("url", "parent_id", "type", "size")
+            )
+            batch = []
+    History.objects.bulk_update(batch, ("url", "parent_id", "type", "size"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0005_filesystem_snapshot"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="history",
+            name="url",
+            field=models.CharField(default=None, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name="history",
+            name="parent_id",
+            field=models.CharField(default=None, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name="history",
+            name="type",
+            field=models.PositiveSmallIntegerField(
+                choices=[(1, "FOLDER"), (2, "FILE")], default=2
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="history",
+            name="size",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(positions_to_columns, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="history",
+            name="position",
+        ),
+        migrations.AddIndex(
+            model_name="history",
+            index=models.Index(
+                fields=["node", "change_date"],
+                name="core_histor_node_id_34a171_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.15 on 2026-10-18 19:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0006_history_columns"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="filesystem",
+            index=models.Index(
+                fields=["type", "date", "id"],
+                name="core_filesy_type_f48ccf_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 3.2.15 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0007_filesystem_type_date_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("items", models.JSONField()),
+                ("update_date", models.DateTimeField()),
+                ("keys", models.JSONField(default=list)),
+                (
+                    "status",
+                    models.PositiveSmallIntegerField(
+                        choices=[
+                            (1, "PENDING"),
+                            (2, "RUNNING"),
+                            (3, "DONE"),
+                            (4, "FAILED"),
+                        ],
+                        default=1,
+                    ),
+                ),
+                ("error", models.JSONField(default=None, null=True)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "started",
+                    models.DateTimeField(default=None, null=True),
+                ),
+                (
+                    "finished",
+                    models.DateTimeField(default=None, null=True),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="importjob",
+            index=models.Index(
+                fields=["status", "id"], name="core_import_status_0b2b0a_idx"
+            ),
+        ),
+    ]
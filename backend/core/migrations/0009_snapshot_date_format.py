@@ -0,0 +1,36 @@
+import json
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def rewrite_dates(apps, schema_editor):
+    """Даты в готовых снимках узлов переводятся в %Y-%m-%dT%H:%M:%SZ."""
+    FileSystem = apps.get_model("core", "FileSystem")
+    rows = (
+        FileSystem.objects.filter(snapshot__isnull=False)
+        .values_list("id", "date", "snapshot")
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    batch = []
+    for node_id, date, snapshot in rows:
+        data = json.loads(snapshot)
+        data["date"] = date.strftime("%Y-%m-%dT%H:%M:%SZ")
+        snapshot = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        batch.append(FileSystem(id=node_id, snapshot=snapshot))
+        if len(batch) == BATCH_SIZE:
+            FileSystem.objects.bulk_update(batch, ("snapshot",))
+            batch = []
+    FileSystem.objects.bulk_update(batch, ("snapshot",))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0008_importjob"),
+    ]
+
+    operations = [
+        migrations.RunPython(rewrite_dates, migrations.RunPython.noop),
+    ]
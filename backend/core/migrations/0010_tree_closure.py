@@ -0,0 +1,60 @@
+# Generated by Django 3.2.15 on 2026-10-18 19:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0009_snapshot_date_format"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TreeClosure",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("depth", models.PositiveIntegerField()),
+                (
+                    "ancestor",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="descendant_links",
+                        to="core.filesystem",
+                    ),
+                ),
+                (
+                    "descendant",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="ancestor_links",
+                        to="core.filesystem",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="treeclosure",
+            index=models.Index(
+                fields=["descendant", "depth"],
+                name="core_treecl_descend_7f68cc_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="treeclosure",
+            constraint=models.UniqueConstraint(
+                fields=("ancestor", "descendant"), name="unique_tree_link"
+            ),
+        ),
+    ]
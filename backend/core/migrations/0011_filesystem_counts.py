@@ -0,0 +1,54 @@
+# Generated by Django 3.2.15 on 2026-10-18 20:08
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+TYPE_FILE = 2
+
+
+def fill_counts(apps, schema_editor):
+    """Счетчики файлов и папок в поддеревьях по parent_id."""
+    FileSystem = apps.get_model("core", "FileSystem")
+    parents, files = {}, set()
+    rows = FileSystem.objects.values_list("id", "parent_id", "type")
+    for node_id, parent_id, node_type in rows.iterator(chunk_size=BATCH_SIZE):
+        parents[node_id] = parent_id
+        if node_type == TYPE_FILE:
+            files.add(node_id)
+    counts = defaultdict(lambda: [0, 0])
+    for node_id, parent_id in parents.items():
+        index = 0 if node_id in files else 1
+        while parent_id is not None:
+            counts[parent_id][index] += 1
+            parent_id = parents[parent_id]
+    FileSystem.objects.bulk_update(
+        [
+            FileSystem(id=node_id, file_count=file_count, folder_count=count)
+            for node_id, (file_count, count) in counts.items()
+        ],
+        ("file_count", "folder_count"),
+        batch_size=BATCH_SIZE,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0010_tree_closure"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="filesystem",
+            name="file_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="filesystem",
+            name="folder_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counts, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,12 @@
-from django.db import connection, models, reset_queries, transaction
-from django.db.models import F
+from collections import defaultdict
+from typing import Iterable
+
+import orjson
+from django.conf import settings
+from django.db import connection, models, reset_queries
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from django.utils.module_loading import import_string
 from mptt.models import MPTTModel, TreeForeignKey
 
 TYPE_FOLDER = 1
@@ -9,6 +16,27 @@ TYPE_CHOICES = (
     (TYPE_FILE, "FILE"),
 )
 TYPE_NAME = dict(reversed(item) for item in TYPE_CHOICES)
+TYPE_DISPLAY = dict(TYPE_CHOICES)
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# Даты в UTC без микросекунд: %Y-%m-%dT%H:%M:%SZ, как в спецификации.
+ORJSON_OPTIONS = (
+    orjson.OPT_UTC_Z | orjson.OPT_OMIT_MICROSECONDS | orjson.OPT_NAIVE_UTC
+)
+JOB_PENDING = 1
+JOB_RUNNING = 2
+JOB_DONE = 3
+JOB_FAILED = 4
+JOB_STATUS_CHOICES = (
+    (JOB_PENDING, "PENDING"),
+    (JOB_RUNNING, "RUNNING"),
+    (JOB_DONE, "DONE"),
+    (JOB_FAILED, "FAILED"),
+)
+PROPAGATION_BATCH_SIZE = 500
+HISTORY_BATCH_SIZE = 1000
+SNAPSHOT_FIELDS = ("id", "url", "type", "parent_id", "date", "size")
+TOTALS_FIELDS = ("size", "file_count", "folder_count", "date")
+TOTALS_BATCH_SIZE = 1000
 
 
 class FileSystem(MPTTModel):
@@ -24,23 +52,40 @@ class FileSystem(MPTTModel):
     )
     date = models.DateTimeField()
     size = models.IntegerField(default=0)
+    snapshot = models.TextField(null=True, editable=False)
+    # Файлы и папки во всем поддереве папки, без нее самой. Ведутся тем же
+    # SizePropagation, что и size.
+    file_count = models.IntegerField(default=0)
+    folder_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=("type", "date", "id"))]
 
     def __str__(self):
         return self.id
 
-    def move_to(self, target, old_size: int):
-        recount_size_set_data(instance=self, old_size=-old_size)
-        super(FileSystem, self).move_to(target)
-        recount_size_set_data(instance=self)
-
-    def as_json(self):
-        return dict(
-            id=self.id,
-            url=self.url,
-            date=self.date.strftime("%Y-%m-%dT%H:%M:%SZ"),
-            parentId=self.parent_id,
-            size=self.size,
-            type=self.get_type_display(),
+    def save(self, *args, **kwargs):
+        self.snapshot = self.render_snapshot()
+        super(FileSystem, self).save(*args, **kwargs)
+
+    def render_snapshot(self):
+        if not settings.NODES_SNAPSHOTS:
+            return None
+        return render_snapshot(
+            *(getattr(self, field) for field in SNAPSHOT_FIELDS)
+        )
+
+    def get_ancestors(self, ascending=False, include_self=False):
+        return tree_backend().get_ancestors(self, ascending, include_self)
+
+    def get_descendants(self, include_self=False):
+        return tree_backend().get_descendants(self, include_self)
+
+    def subtree_counts(self) -> tuple:
+        """(файлов, папок) в поддереве вместе с самим узлом."""
+        return (
+            self.file_count + self.is_file(),
+            self.folder_count + self.is_folder(),
         )
 
     def is_folder(self):
@@ -50,6 +95,70 @@ class FileSystem(MPTTModel):
         return self.type == TYPE_FILE
 
 
+def format_date(date) -> str:
+    return date.astimezone(timezone.utc).strftime(DATE_FORMAT)
+
+
+def render_snapshot(node_id, url, node_type, parent_id, date, size) -> str:
+    """JSON узла без children в формате ответа GET /nodes/{id}."""
+    return orjson.dumps(
+        dict(
+            id=node_id,
+            url=url,
+            type=TYPE_DISPLAY[node_type],
+            parentId=parent_id,
+            date=format_date(date),
+            size=size,
+        ),
+        option=ORJSON_OPTIONS,
+    ).decode()
+
+
+def refresh_snapshots(node_ids: list):
+    """Перечитывает узлы после UPDATE с F-выражениями и пересобирает их
+    снимки. По одному SELECT и UPDATE на PROPAGATION_BATCH_SIZE узлов."""
+    while node_ids:
+        batch = node_ids[:PROPAGATION_BATCH_SIZE]
+        node_ids = node_ids[PROPAGATION_BATCH_SIZE:]
+        nodes = [
+            FileSystem(id=values[0], snapshot=render_snapshot(*values))
+            for values in FileSystem.objects.filter(id__in=batch).values_list(
+                *SNAPSHOT_FIELDS
+            )
+        ]
+        FileSystem.objects.bulk_update(nodes, ("snapshot",))
+
+
+class TreeClosure(models.Model):
+    """Связи предок - потомок для ClosureTree, в том числе связь узла с
+    самим собой с depth = 0."""
+
+    ancestor = models.ForeignKey(
+        FileSystem,
+        on_delete=models.CASCADE,
+        related_name="descendant_links",
+        db_index=False,
+    )
+    descendant = models.ForeignKey(
+        FileSystem,
+        on_delete=models.CASCADE,
+        related_name="ancestor_links",
+        db_index=False,
+    )
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=("ancestor", "descendant"), name="unique_tree_link"
+            )
+        ]
+        indexes = [models.Index(fields=("descendant", "depth"))]
+
+    def __str__(self):
+        return f"{self.ancestor_id} > {self.descendant_id}"
+
+
 class History(models.Model):
     node = models.ForeignKey(
         FileSystem,
@@ -57,48 +166,212 @@ class History(models.Model):
         related_name="history",
     )
     change_date = models.DateTimeField()
-    position = models.TextField()
+    url = models.CharField(null=True, max_length=255, default=None)
+    parent_id = models.CharField(null=True, max_length=50, default=None)
+    type = models.PositiveSmallIntegerField(choices=TYPE_CHOICES)
+    size = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=("node", "change_date"))]
 
     def __str__(self):
         return f"{self.node} - {self.change_date}"
 
 
-def recount_size_set_data(
-    instance: FileSystem, add_operation: bool = True, old_size: int = 0
-):
-    new_date = instance.date
-    if old_size:
-        new_size = old_size
-    else:
-        new_size = instance.size if add_operation else -instance.size
-    with transaction.atomic():
-        instance.get_ancestors().filter(type=TYPE_FOLDER).update(
-            size=F("size") + new_size, date=new_date
-        )
+class ImportJob(models.Model):
+    """Отложенный импорт. keys - деревья ("tree:<tree_id>") и еще не
+    созданные узлы ("node:<id>"), которые он затронет: задания с общими
+    ключами выполняются в порядке постановки в очередь."""
+
+    items = models.JSONField()
+    update_date = models.DateTimeField()
+    keys = models.JSONField(default=list)
+    status = models.PositiveSmallIntegerField(
+        choices=JOB_STATUS_CHOICES, default=JOB_PENDING
+    )
+    error = models.JSONField(null=True, default=None)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, default=None)
+    finished = models.DateTimeField(null=True, default=None)
 
+    class Meta:
+        indexes = [models.Index(fields=("status", "id"))]
 
-def change_size_set_data(instance: FileSystem, old_size: int):
-    new_date = instance.date
-    different_size = instance.size - old_size
-    with transaction.atomic():
-        instance.get_ancestors().filter(type=TYPE_FOLDER).update(
-            size=F("size") + different_size, date=new_date
-        )
+    def __str__(self):
+        return f"{self.id} - {self.get_status_display()}"
+
+
+class SizePropagation:
+    """Накопитель изменений размера и счетчиков file_count, folder_count
+    папок-предков за весь запрос. Изменения суммируются по id папки и
+    записываются вместе с датой одним UPDATE на PROPAGATION_BATCH_SIZE
+    папок."""
+
+    def __init__(self, date):
+        self.date = date
+        self.deltas = defaultdict(int)
+        self.files = defaultdict(int)
+        self.folders = defaultdict(int)
+
+    def add(
+        self, node_ids: Iterable, delta: int, files: int = 0, folders: int = 0
+    ):
+        for node_id in node_ids:
+            self.deltas[node_id] += delta
+            if files:
+                self.files[node_id] += files
+            if folders:
+                self.folders[node_id] += folders
+
+    def add_move(
+        self,
+        old_chain: list,
+        new_chain: list,
+        old_size: int,
+        new_size: int,
+        files: int = 0,
+        folders: int = 0,
+    ) -> list:
+        """Перенос узла размера old_size (после переноса - new_size), в
+        поддереве которого files файлов и folders папок. Цепочки - папки
+        от старого и нового родителя до корня. Начиная с наименьшего общего
+        предка цепочки совпадают: эти папки получают только итоговое
+        изменение размера и не трогаются вовсе, если оно нулевое. Старый и
+        новый родитель меняются всегда. Возвращает общих предков."""
+        common = 0
+        while (
+            common < min(len(old_chain), len(new_chain))
+            and old_chain[-common - 1] == new_chain[-common - 1]
+        ):
+            common += 1
+        old_split, new_split = len(old_chain) - common, len(new_chain) - common
+        shared = old_chain[old_split:]
+        self.add(old_chain[:old_split], -old_size, -files, -folders)
+        self.add(new_chain[:new_split], new_size, files, folders)
+        if new_size != old_size:
+            self.add(shared, new_size - old_size)
+        self.add(old_chain[:1] + new_chain[:1], 0)
+        return shared
+
+    def get(self, node_id: str) -> int:
+        return self.deltas.get(node_id, 0)
 
+    def pop(self, node_id: str) -> int:
+        return self.deltas.pop(node_id, 0)
 
-def set_position_history(node: FileSystem):
-    History.objects.create(
-        node=node, change_date=node.date, position=node.as_json()
+    def get_counts(self, node_id: str) -> tuple:
+        return self.files.get(node_id, 0), self.folders.get(node_id, 0)
+
+    def pop_counts(self, node_id: str) -> tuple:
+        return self.files.pop(node_id, 0), self.folders.pop(node_id, 0)
+
+    def save(self):
+        node_ids = list(self.deltas)
+        while node_ids:
+            batch = node_ids[:PROPAGATION_BATCH_SIZE]
+            node_ids = node_ids[PROPAGATION_BATCH_SIZE:]
+            fields = dict(
+                size=_increment("size", self.deltas, batch),
+                date=self.date,
+                snapshot=None,
+            )
+            if self.files:
+                fields["file_count"] = _increment(
+                    "file_count", self.files, batch
+                )
+            if self.folders:
+                fields["folder_count"] = _increment(
+                    "folder_count", self.folders, batch
+                )
+            FileSystem.objects.filter(id__in=batch).update(**fields)
+        if settings.NODES_SNAPSHOTS:
+            refresh_snapshots(list(self.deltas))
+        self.deltas.clear()
+        self.files.clear()
+        self.folders.clear()
+
+
+def _increment(field: str, deltas: dict, node_ids: list):
+    """F(field) плюс изменение из deltas, один When на каждое значение
+    изменения."""
+    by_delta = defaultdict(list)
+    for node_id in node_ids:
+        if deltas.get(node_id):
+            by_delta[deltas[node_id]].append(node_id)
+    if not by_delta:
+        return F(field)
+    return F(field) + Case(
+        *(
+            When(id__in=ids, then=Value(delta))
+            for delta, ids in by_delta.items()
+        ),
+        default=Value(0),
+        output_field=models.IntegerField(),
+    )
+
+
+def folder_totals(tree_id: int):
+    """Пересчитывает TOTALS_FIELDS папок дерева tree_id по их поддеревьям.
+    Дерево читается одним потоковым запросом снизу вверх по level, в
+    памяти только итоги папок, чьи дети уже начали читаться. Отдает (id,
+    значения в базе, верные значения) для папок, разошедшихся с
+    поддеревом, и для папок над ними: их ответы в кэше тоже устарели.
+    Дата папки не раньше дат потомков, но может быть позже: удаление
+    меняет дату папки без файлов."""
+    totals = {}
+    rows = (
+        FileSystem.objects.filter(tree_id=tree_id)
+        .order_by("-level")
+        .values_list("id", "parent_id", "type", *TOTALS_FIELDS)
+    )
+    for node_id, parent_id, node_type, *stored in rows.iterator(
+        chunk_size=TOTALS_BATCH_SIZE
+    ):
+        stored = tuple(stored)
+        if node_type == TYPE_FOLDER:
+            size, files, folders, date, stale = totals.pop(
+                node_id, (0, 0, 0, None, False)
+            )
+            date = stored[3] if date is None else max(stored[3], date)
+            expected = (size, files, folders, date)
+            stale = stale or stored != expected
+            if stale:
+                yield node_id, stored, expected
+            folders += 1
+        else:
+            size, files, folders, date = stored[0], 1, 0, stored[3]
+            stale = False
+        if parent_id is None:
+            continue
+        total = totals.setdefault(parent_id, [0, 0, 0, None, False])
+        total[0] += size
+        total[1] += files
+        total[2] += folders
+        total[3] = date if total[3] is None else max(total[3], date)
+        total[4] = total[4] or stale
+
+
+def tree_backend():
+    """Движок дерева из настройки TREE_BACKEND."""
+    return import_string(settings.TREE_BACKEND)()
+
+
+def _position(node: FileSystem) -> History:
+    return History(
+        node=node,
+        change_date=node.date,
+        url=node.url,
+        parent_id=node.parent_id,
+        type=node.type,
+        size=node.size,
     )
 
 
 def bulk_position_history(nodes: list):
     if nodes:
-        data = [
-            History(node=node, change_date=node.date, position=node.as_json())
-            for node in nodes
-        ]
-        History.objects.bulk_create(data)
+        History.objects.bulk_create(
+            [_position(node) for node in nodes], batch_size=HISTORY_BATCH_SIZE
+        )
 
 
 def print_latest_queries():
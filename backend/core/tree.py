@@ -0,0 +1,506 @@
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, Q, Subquery, Value, When
+from mptt.models import MPTTModel
+
+from core.models import (
+    PROPAGATION_BATCH_SIZE,
+    SNAPSHOT_FIELDS,
+    FileSystem,
+    History,
+    SizePropagation,
+    TreeClosure,
+    tree_backend,
+)
+
+TREE_FIELDS = ("tree_id", "lft", "rght", "level")
+REBUILD_BATCH_SIZE = 1000
+INSERT_BATCH_SIZE = 1000
+# Первый ключ advisory-блокировок деревьев, второй ключ - tree_id.
+TREE_LOCK_KEY = 1869771333
+NEW_TREE = 0
+
+
+class TreesChangedError(Exception):
+    """Узлы, прочитанные под блокировкой, оказались в незаблокированных
+    деревьях. tree_ids - полный набор деревьев для повтора."""
+
+    def __init__(self, tree_ids: set):
+        super().__init__(tree_ids)
+        self.tree_ids = tree_ids
+
+
+class TreeNode:
+    """Легковесный узел для пересчета nested set без загрузки моделей."""
+
+    __slots__ = ("id", "parent_id", "tree_id", "lft", "rght", "level", "old")
+    FIELDS = ("parent_id", "tree_id", "lft", "rght", "level")
+
+    def __init__(self, id, parent_id, tree_id, lft, rght, level):
+        self.id, self.parent_id, self.tree_id = id, parent_id, tree_id
+        self.lft, self.rght, self.level = lft, rght, level
+        self.old = (parent_id, tree_id, lft, rght, level)
+
+    def is_changed(self) -> bool:
+        return self.old != (
+            self.parent_id,
+            self.tree_id,
+            self.lft,
+            self.rght,
+            self.level,
+        )
+
+    def was(self, field: str):
+        """Значение поля field до пересчета."""
+        return self.old[self.FIELDS.index(field)]
+
+
+def build_nested_set(
+    root, children: dict, tree_id: int, left: int, level: int
+) -> int:
+    """Раскладывает поддерево root по nested set, начиная с left. children -
+    словарь id родителя -> список дочерних узлов. Возвращает rght корня."""
+    root.tree_id, root.lft, root.level = tree_id, left, level
+    cursor = left
+    stack = [(root, iter(children.get(root.id, ())))]
+    while stack:
+        node, nodes = stack[-1]
+        child = next(nodes, None)
+        cursor += 1
+        if child is None:
+            node.rght = cursor
+            stack.pop()
+        else:
+            child.tree_id, child.lft = tree_id, cursor
+            child.level = node.level + 1
+            stack.append((child, iter(children.get(child.id, ()))))
+    return cursor
+
+
+def _offset(field: str, gaps: list) -> Case:
+    shifts, total = [], 0
+    for target, size in gaps:
+        total += size
+        shifts.append((target, total))
+    return Case(
+        *(
+            When(**{f"{field}__gt": target}, then=Value(shift))
+            for target, shift in reversed(shifts)
+        ),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def create_space(tree_id: int, gaps: list):
+    """Освобождает место в дереве tree_id одним UPDATE. gaps - список пар
+    (target, size) по возрастанию target: после каждой точки target
+    добавляется size позиций."""
+    FileSystem.objects.filter(tree_id=tree_id, rght__gt=gaps[0][0]).update(
+        lft=F("lft") + _offset("lft", gaps),
+        rght=F("rght") + _offset("rght", gaps),
+    )
+
+
+def shift_nodes(nodes, tree_id: int, gaps: list):
+    """То же, что create_space, но для узлов в памяти."""
+    for node in nodes:
+        if node.tree_id != tree_id:
+            continue
+        left, right = node.lft, node.rght
+        for target, size in gaps:
+            if left > target:
+                node.lft += size
+            if right > target:
+                node.rght += size
+
+
+def rebuild_trees(tree_ids, parents: dict) -> int:
+    """Пересчитывает nested set деревьев tree_ids в памяти с учетом новых
+    родителей parents (id -> parent_id) и записывает только изменившиеся
+    узлы. Перенесенные узлы становятся последними детьми. Возвращает число
+    перезаписанных узлов."""
+    queryset = FileSystem.objects.filter(tree_id__in=tree_ids).order_by(
+        "tree_id", "lft"
+    )
+    changed = [
+        FileSystem(
+            id=node.id,
+            parent_id=node.parent_id,
+            tree_id=node.tree_id,
+            lft=node.lft,
+            rght=node.rght,
+            level=node.level,
+        )
+        for node in _rebuild(queryset, parents, None)
+        if node.is_changed()
+    ]
+    FileSystem.objects.bulk_update(
+        changed, ("parent",) + TREE_FIELDS, batch_size=REBUILD_BATCH_SIZE
+    )
+    return len(changed)
+
+
+def rebuild_subtree(root: FileSystem, parents: dict) -> int:
+    """То же, что rebuild_trees, но только для поддерева root: все переносы
+    parents остаются внутри него, поэтому root и всё вне его поддерева
+    сохраняют свои lft и rght. Сдвиги узлов записываются одним UPDATE по
+    диапазонам старых lft и rght, а не построчно."""
+    queryset = FileSystem.objects.filter(
+        tree_id=root.tree_id, lft__gte=root.lft, lft__lte=root.rght
+    ).order_by("lft")
+    nodes = _rebuild(queryset, parents, root.id)
+    FileSystem.objects.bulk_update(
+        [
+            FileSystem(id=node_id, parent_id=parent_id)
+            for node_id, parent_id in parents.items()
+        ],
+        ("parent",),
+        batch_size=REBUILD_BATCH_SIZE,
+    )
+    lft = _shift_ranges(nodes, "lft", "lft")
+    rght = _shift_ranges(nodes, "rght", "rght")
+    level = _shift_ranges(nodes, "level", "lft")
+    if not lft and not rght:
+        return 0
+    FileSystem.objects.filter(
+        reduce(
+            or_,
+            (
+                Q(**{f"{key}__range": (start, end)})
+                for ranges, key in ((lft, "lft"), (rght, "rght"))
+                for start, end, _ in ranges
+            ),
+        ),
+        tree_id=root.tree_id,
+    ).update(
+        lft=F("lft") + _range_offset("lft", lft),
+        rght=F("rght") + _range_offset("rght", rght),
+        level=F("level") + _range_offset("lft", level),
+    )
+    return sum(node.is_changed() for node in nodes)
+
+
+def _rebuild(queryset, parents: dict, root_id) -> list:
+    nodes = {}
+    queryset = queryset.values_list("id", "parent_id", *TREE_FIELDS)
+    for values in queryset.iterator(chunk_size=REBUILD_BATCH_SIZE):
+        nodes[values[0]] = TreeNode(*values)
+
+    children = defaultdict(list)
+    roots = []
+    for node in nodes.values():
+        if node.id in parents:
+            continue
+        if node.parent_id is None or node.id == root_id:
+            roots.append(node)
+        else:
+            children[node.parent_id].append(node)
+    for node_id, parent_id in parents.items():
+        nodes[node_id].parent_id = parent_id
+        children[parent_id].append(nodes[node_id])
+
+    for root in roots:
+        if root_id is None:
+            build_nested_set(root, children, root.tree_id, 1, 0)
+        else:
+            build_nested_set(
+                root, children, root.tree_id, root.lft, root.level
+            )
+    return list(nodes.values())
+
+
+def _shift_ranges(nodes: list, field: str, key: str) -> list:
+    """Сдвиги поля field одного дерева как диапазоны (от, до, сдвиг) по
+    старому значению key: соседние по key узлы с одинаковым сдвигом дают
+    один диапазон. Диапазоны без сдвига отбрасываются."""
+    ranges = []
+    for node in sorted(nodes, key=lambda node: node.was(key)):
+        start, shift = node.was(key), getattr(node, field) - node.was(field)
+        if ranges and ranges[-1][2] == shift:
+            ranges[-1][1] = start
+        else:
+            ranges.append([start, start, shift])
+    return [tuple(item) for item in ranges if item[2]]
+
+
+def _range_offset(field: str, ranges: list) -> Case:
+    return Case(
+        *(
+            When(**{f"{field}__range": (start, end)}, then=Value(shift))
+            for start, end, shift in ranges
+        ),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def lock_trees(tree_ids):
+    """Берет транзакционные advisory-блокировки деревьев tree_ids по
+    возрастанию tree_id: записи в одно дерево идут по очереди, в разные -
+    параллельно, а общий порядок исключает взаимные блокировки. NEW_TREE -
+    блокировка выдачи новых tree_id. SQLite и так пишет последовательно."""
+    if connection.vendor != "postgresql" or not tree_ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_advisory_xact_lock(%s, tree_id) FROM "
+            "(SELECT unnest(%s::integer[]) AS tree_id ORDER BY 1) AS trees",
+            [TREE_LOCK_KEY, sorted(tree_ids)],
+        )
+
+
+def check_locked(tree_ids: set, nodes):
+    """TreesChangedError, если узлы nodes перенесли в другое дерево, пока
+    ждали блокировки."""
+    loaded = {node.tree_id for node in nodes}
+    if not loaded <= tree_ids:
+        raise TreesChangedError(tree_ids | loaded)
+
+
+def run_locked(tree_ids: set, action):
+    """Выполняет action(tree_ids) в транзакции под блокировками деревьев
+    tree_ids. При TreesChangedError транзакция откатывается вместе с
+    блокировками и повторяется с расширенным набором деревьев."""
+    while True:
+        try:
+            with transaction.atomic():
+                lock_trees(tree_ids)
+                return action(tree_ids)
+        except TreesChangedError as error:
+            tree_ids = error.tree_ids
+
+
+def in_batches(items: list, size: int = PROPAGATION_BATCH_SIZE):
+    while items:
+        yield items[:size]
+        items = items[size:]
+
+
+def delete_rows(subtree) -> list:
+    """Удаляет узлы subtree и их историю без загрузки узлов. Обычный
+    delete() собрал бы всё поддерево через CASCADE-коллектор. Возвращает
+    id удаленных узлов, чтобы сбросить их ответы в кэше."""
+    ids = list(subtree.values_list("id", flat=True))
+    if ids:
+        History.objects.filter(node_id__in=subtree.values("id")).delete()
+        subtree._raw_delete(subtree.db)
+    return ids
+
+
+def delete_subtrees(nodes: list, propagation: SizePropagation) -> list:
+    """Удаляет узлы со всеми поддеревьями и историей через движок дерева.
+    Узлы, чьи предки тоже удаляются, отбрасываются. Уменьшение размера и
+    счетчиков общих предков суммируется в propagation. Возвращает id всех
+    удаленных узлов."""
+    tree = tree_backend()
+    ids = {node.id for node in nodes}
+    parents = {
+        node.id: node.parent_id
+        for node in tree.ancestors(nodes) + list(nodes)
+    }
+    roots = []
+    for node in nodes:
+        chain = []
+        node_id = node.parent_id
+        while node_id is not None and node_id not in ids:
+            chain.append(node_id)
+            node_id = parents[node_id]
+        if node_id is None:
+            roots.append(node)
+            files, folders = node.subtree_counts()
+            propagation.add(chain, -node.size, -files, -folders)
+    return tree.delete(roots)
+
+
+def _subtrees(nodes: list) -> Q:
+    return reduce(
+        or_,
+        (
+            Q(tree_id=node.tree_id, lft__gte=node.lft, lft__lte=node.rght)
+            for node in nodes
+        ),
+    )
+
+
+def _ancestors(nodes: list) -> Q:
+    return reduce(
+        or_,
+        (
+            Q(tree_id=node.tree_id, lft__lt=node.lft, rght__gt=node.rght)
+            for node in nodes
+        ),
+    )
+
+
+class NestedSetTree:
+    """Nested set django-mptt. Поддерево читается одним диапазонным
+    запросом, но вставка и перенос сдвигают lft/rght всех узлов дерева
+    правее места изменения."""
+
+    def get_ancestors(self, node, ascending: bool, include_self: bool):
+        return MPTTModel.get_ancestors(
+            node, ascending=ascending, include_self=include_self
+        )
+
+    def get_descendants(self, node, include_self: bool):
+        return MPTTModel.get_descendants(node, include_self=include_self)
+
+    def ancestors(self, nodes: list) -> list:
+        """Все предки узлов nodes без повторов."""
+        ancestors = {}
+        for batch in in_batches(list(nodes)):
+            ancestors.update(
+                (node.id, node)
+                for node in FileSystem.objects.filter(_ancestors(batch))
+            )
+        return list(ancestors.values())
+
+    def subtree_pages(self, node_id: str, size: int):
+        """Строки (snapshot, lft, rght, *SNAPSHOT_FIELDS) поддерева node_id
+        в порядке lft страницами по size. Каждая страница - отдельный запрос
+        по ключу lft, границы поддерева берутся подзапросом к узлу. Если
+        дерево изменилось между страницами, они могут смешать состояния, как
+        страницы истории. Нет страниц, если узла нет."""
+        node = FileSystem.objects.filter(id=node_id)
+        queryset = (
+            FileSystem.objects.filter(
+                tree_id=Subquery(node.values("tree_id")),
+                lft__lte=Subquery(node.values("rght")),
+            )
+            .order_by("lft")
+            .values_list("snapshot", "lft", "rght", *SNAPSHOT_FIELDS)
+        )
+        rows = queryset.filter(lft__gte=Subquery(node.values("lft")))
+        while True:
+            page = list(rows[:size])
+            if page:
+                yield page
+            if len(page) < size:
+                return
+            rows = queryset.filter(lft__gt=page[-1][1])
+
+    def insert(self, created: list, nodes: dict, existing: list):
+        """Раскладывает новые узлы по nested set и записывает их. created
+        идут в топологическом порядке, у новых корней уже есть tree_id,
+        родители остальных - в created или в nodes. Место под поддеревья в
+        существующих деревьях освобождается одним UPDATE на дерево, узлы
+        existing сдвигаются в памяти."""
+        created_ids = set()
+        children = defaultdict(list)
+        attached = defaultdict(list)
+        roots = []
+        for node in created:
+            created_ids.add(node.id)
+            if node.parent_id is None:
+                roots.append(node)
+            elif node.parent_id in created_ids:
+                children[node.parent_id].append(node)
+            else:
+                attached[node.parent_id].append(node)
+        for node in roots:
+            build_nested_set(node, children, node.tree_id, 1, 0)
+
+        attached_by_tree = defaultdict(list)
+        for parent_id in attached:
+            parent = nodes[parent_id]
+            attached_by_tree[parent.tree_id].append(parent)
+        for tree_id, parents in attached_by_tree.items():
+            parents.sort(key=lambda parent: parent.rght)
+            gaps, shift = [], 0
+            for parent in parents:
+                start = cursor = parent.rght + shift
+                for node in attached[parent.id]:
+                    cursor = build_nested_set(
+                        node, children, tree_id, cursor, parent.level + 1
+                    )
+                    cursor += 1
+                gaps.append((parent.rght - 1, cursor - start))
+                shift += cursor - start
+            create_space(tree_id, gaps)
+            shift_nodes(existing, tree_id, gaps)
+        FileSystem.objects.bulk_create(created, batch_size=INSERT_BATCH_SIZE)
+
+    def move(self, moves: list):
+        """Переносит узлы последними детьми новых родителей. moves - пары
+        (узел, новый родитель). От IMPORT_REBUILD_MOVES переносов они
+        применяются вместе: переносы внутри дерева пересчитывают одно
+        поддерево общего предка всех переносов, переносы между деревьями -
+        затронутые деревья целиком."""
+        if len(moves) < settings.IMPORT_REBUILD_MOVES:
+            for node, target in moves:
+                self.move_node(node, target)
+            return
+        crossed, by_tree, parents = set(), defaultdict(list), {}
+        for node, target in moves:
+            if node.tree_id == target.tree_id:
+                by_tree[node.tree_id].extend((node, target))
+            else:
+                crossed.update((node.tree_id, target.tree_id))
+            parents[node.id] = target.id
+        for tree_id, nodes in by_tree.items():
+            if tree_id in crossed:
+                continue
+            root = (
+                FileSystem.objects.filter(
+                    tree_id=tree_id,
+                    lft__lte=min(node.lft for node in nodes),
+                    rght__gte=max(node.rght for node in nodes),
+                )
+                .order_by("-lft")
+                .first()
+            )
+            if root.id in parents:
+                crossed.add(tree_id)
+                continue
+            rebuild_subtree(
+                root,
+                {node.id: parents[node.id] for node in nodes[::2]},
+            )
+        if crossed:
+            rebuild_trees(
+                crossed,
+                {
+                    node.id: target.id
+                    for node, target in moves
+                    if node.tree_id in crossed
+                },
+            )
+        for node, target in moves:
+            node.parent_id = target.id
+
+    def move_node(self, node, target, position: str = "last-child"):
+        node.refresh_from_db(fields=TREE_FIELDS)
+        target.refresh_from_db(fields=TREE_FIELDS)
+        MPTTModel.move_to(node, target, position)
+
+    def delete(self, roots: list) -> list:
+        """Удаляет поддеревья roots диапазонными DELETE и закрывает дыры
+        одним UPDATE на дерево. Возвращает id удаленных узлов."""
+        gaps, deleted = defaultdict(list), []
+        for batch in in_batches(roots):
+            deleted.extend(
+                delete_rows(FileSystem.objects.filter(_subtrees(batch)))
+            )
+        for node in sorted(roots, key=lambda node: node.lft):
+            if node.parent_id is not None:
+                gaps[node.tree_id].append(
+                    (node.rght, node.lft - node.rght - 1)
+                )
+        for tree_id, tree_gaps in gaps.items():
+            create_space(tree_id, tree_gaps)
+        return deleted
+
+    def rebuild(self) -> int:
+        """Пересчитывает nested set всех деревьев. Связи таблицы замыкания
+        от прежнего движка удаляются: они ссылаются на узлы, которые этот
+        движок удаляет без них."""
+        TreeClosure.objects.all().delete()
+        tree_ids = FileSystem.objects.filter(parent=None).values_list(
+            "tree_id", flat=True
+        )
+        return rebuild_trees(set(tree_ids), {})